@@ -0,0 +1,184 @@
+"""
+Run the whole logger against local stand-ins and report where a cycle's time goes.
+
+The gateway, weather API and IP lookup are served by a local HTTP server with a configurable delay, the sheet is an
+in-memory fake that counts API calls, and the clock is compressed so a day's polling takes seconds. Reports the
+latency of each stage, the requests made per cycle and the Sheets API calls made per row. Run from the repository
+root:
+
+    python -m benchmarks.bench_cycle --cycles 30 --latency 50
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import runner
+import src.csv_writer
+import src.scheduler
+import src.solar_reader
+import src.weather
+from benchmarks.harness import CompressedClock, FakeSheetClient, GatewayPages, StageTimer, StandInServer, \
+    fake_sheets
+from src.discovery import SubnetScanner
+from src.sheet_manager import SheetReader
+from src.solar_reader import SolarReader
+from src.weather import WeatherData
+
+log = logging.getLogger()
+
+
+def bench_discovery(latency: float, device_host: int, probe_timeout: float) -> float:
+    """
+    Time a subnet scan of 127.0.0.x with a stand-in gateway listening at 127.0.0.<device_host>.
+    The other hosts refuse the connection straight away, so this measures the scanner's own overhead plus one probe.
+    """
+    server = StandInServer("127.0.0.{}".format(device_host), latency=latency)
+    server.route("/", lambda: b"<html><body>enphase energy</body></html>")
+    server.start()
+    try:
+        scanner = SubnetScanner("enphase", "127.0.0", probe_timeout=probe_timeout, port=server.server_address[1])
+        found = scanner.scan()
+        if found != "127.0.0.{}".format(device_host):
+            log.warning("Discovery found {} rather than the stand-in.".format(found))
+        return scanner.last_duration
+    finally:
+        server.stop()
+
+
+def bench_cycles(args, work_dir: str) -> dict:
+    clock = CompressedClock(args.factor)
+    pages = GatewayPages(clock, refresh_period=args.refresh_period)
+
+    server = StandInServer(latency=args.latency / 1000)
+    server.add_gateway(pages, json_api=args.backend != "html")
+    server.add_weather()
+    server.add_ip_lookup()
+    server.start()
+
+    config_path = os.path.join(work_dir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump({
+            "service_account_json": os.path.join(work_dir, "service_account.json"),
+            "chart_url": "https://docs.google.com/spreadsheets/d/bench",
+            "weather_api_key": "bench",
+            "weather_city_id": 0,
+            "weather_cache_path": os.path.join(work_dir, "weather_cache.json")
+        }, f)
+
+    client = FakeSheetClient()
+    timer = StageTimer()
+
+    try:
+        with clock.patched(runner, src.scheduler, src.solar_reader, src.csv_writer, src.weather), \
+                fake_sheets(client):
+            sheet_reader = SheetReader(config_path)
+            solar_reader = SolarReader("enphase", "127.0.0", static_ip=server.address, backend=args.backend)
+            weather_reader = WeatherData(config_path)
+            weather_reader.api_url = "http://{}/data/2.5/weather?id={{}}&APPID={{}}".format(server.address)
+
+            solar_data = runner.SolarData(sheet_reader, solar_reader, weather_reader,
+                                          csv_path=os.path.join(work_dir, "data.csv"),
+                                          concurrent=args.mode == "async")
+            solar_data.ip_lookup_url = "http://{}/ip".format(server.address)
+
+            timer.wrap(solar_reader, "get_response", "gateway request")
+            timer.wrap(solar_reader._parser, "parse_production", "parse production")
+            timer.wrap(solar_reader._parser, "parse_home", "parse home")
+            timer.wrap(solar_reader._json_parser, "parse_production", "parse production")
+            timer.wrap(solar_reader._json_parser, "parse_inverters", "parse home")
+            timer.wrap(weather_reader, "get_cloud_levels", "weather")
+            timer.wrap(solar_data._ip_session, "get", "ip lookup")
+            timer.wrap(sheet_reader, "write_cells", "sheet write")
+            timer.wrap(solar_data.database_writer, "write_row", "csv write")
+            timer.wrap(solar_data, "poll_once", "cycle")
+
+            # Setting up the clients isn't part of a cycle
+            sheet_reader.connect()
+            server.counts.clear()
+            client.calls.clear()
+            start = clock.time()
+
+            for _ in range(args.cycles):
+                solar_data.poll_once()
+                solar_data.scheduler.wait()
+
+            simulated = clock.time() - start
+            solar_data.close()
+            sheet_reader.close()
+    finally:
+        server.stop()
+
+    rows = len(timer.durations["csv write"])
+    return {
+        "stages": timer.summary(),
+        "requests": dict(server.counts),
+        "sheet_calls": dict(client.calls),
+        "api_calls": client.api_calls,
+        "rows": rows,
+        "refreshes": int(simulated // args.refresh_period),
+        "simulated": simulated,
+        "backend": solar_reader.backend
+    }
+
+
+def print_report(args, result: dict, discovery: float = None):
+    print("{} cycles in {:.0f} simulated minutes ({} mode, {} backend, {:.0f}ms latency), {} rows written, "
+          "{} gateway refreshes".format(args.cycles, result["simulated"] / 60, args.mode, result["backend"],
+                                        args.latency, result["rows"], result["refreshes"]))
+    print()
+    print("{:<18} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}".format("stage", "calls", "errors", "mean ms", "p50 ms",
+                                                              "p95 ms", "max ms"))
+    for row in result["stages"]:
+        print("{stage:<18} {calls:>6} {errors:>6} {mean_ms:>9.2f} {p50_ms:>9.2f} {p95_ms:>9.2f} {max_ms:>9.2f}"
+              .format(**row))
+    print()
+    print("Requests per cycle:")
+    for path, count in sorted(result["requests"].items()):
+        print("  {:<18} {:.2f}".format(path, count / args.cycles))
+    print()
+    per_row = result["api_calls"] / result["rows"] if result["rows"] else float("nan")
+    print("Sheets API calls: {} ({:.2f} per row) {}".format(result["api_calls"], per_row, result["sheet_calls"]))
+    if discovery is not None:
+        print("Subnet discovery: {:.3f}s".format(discovery))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full polling cycles against local stand-ins.")
+    parser.add_argument("-n", "--cycles", help="Number of cycles to run", type=int, default=30)
+    parser.add_argument("-l", "--latency", help="Delay on every stand-in response, in milliseconds", type=float,
+                        default=20)
+    parser.add_argument("-f", "--factor", help="How much faster than real time the clock runs", type=float,
+                        default=600)
+    parser.add_argument("-r", "--refresh-period", help="How often the stand-in gateway updates, in simulated "
+                                                       "seconds", type=float, default=600)
+    parser.add_argument("-m", "--mode", help="How each cycle gathers its data", choices=["serial", "async"],
+                        default="serial")
+    parser.add_argument("-b", "--backend", help="How to read the stand-in gateway. With html, it has no JSON API.",
+                        choices=SolarReader.backends, default="auto")
+    parser.add_argument("--discovery-host", help="Last octet of the stand-in gateway for the discovery run, or 0 "
+                                                 "to skip it", type=int, default=200)
+    parser.add_argument("--probe-timeout", help="Discovery probe timeout, in seconds", type=float, default=2)
+    args = parser.parse_args()
+
+    # The logger's own output would drown the report out
+    log.setLevel(logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(prefix="bench_cycle")
+    try:
+        result = bench_cycles(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    discovery = None
+    if args.discovery_host:
+        discovery = bench_discovery(args.latency / 1000, args.discovery_host, args.probe_timeout)
+
+    print_report(args, result, discovery)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
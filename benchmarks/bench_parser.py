@@ -0,0 +1,74 @@
+"""
+Compare the ways we can pull values out of the Envoy's pages.
+
+Runs each parser against the pages in benchmarks/fixtures, checks that they agree, and prints how long a parse
+takes on average. Run from the repository root:
+
+    python -m benchmarks.bench_parser
+"""
+import argparse
+import os
+import timeit
+
+from lxml import html
+
+from src.envoy_json import EnvoyJSONParser
+from src.envoy_parser import EnvoyParser, parse_wh, parse_watts, parse_mi
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixture(name: str) -> bytes:
+    with open(os.path.join(fixtures_dir, name), "rb") as f:
+        return f.read()
+
+
+def parse_original(production: bytes, home: bytes) -> tuple:
+    """The way SolarReader used to do it: a fresh tree and an uncompiled xpath for every value."""
+    wh = parse_wh(html.fromstring(production).xpath("/html/body/div[1]/table/tr[3]/td[2]/text()")[0])
+    watts = parse_watts(html.fromstring(production).xpath("/html/body/div[1]/table/tr[2]/td[2]/text()")[0])
+    mi = parse_mi(html.fromstring(home).xpath("/html/body/table/tr/td[2]/table/tr[5]/td[2]/text()")[0])
+    return wh, watts, mi
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Envoy page parsers.")
+    parser.add_argument("-n", "--number", help="Number of parses to time for each parser", type=int, default=2000)
+    args = parser.parse_args()
+
+    production = load_fixture("production.html")
+    home = load_fixture("home.html")
+
+    api_production = load_fixture("api_v1_production.json")
+    production_json = load_fixture("production.json")
+
+    tree_parser = EnvoyParser(fast_path=False)
+    fast_parser = EnvoyParser(fast_path=True)
+    json_parser = EnvoyJSONParser()
+
+    candidates = {
+        "original": lambda: parse_original(production, home),
+        "compiled xpath": lambda: tree_parser.parse_production(production) + (tree_parser.parse_home(home),),
+        "fast path": lambda: fast_parser.parse_production(production) + (fast_parser.parse_home(home),),
+        "json api": lambda: json_parser.parse_production(api_production)[:2] + (json_parser.parse_inverters(
+            production_json),),
+    }
+
+    expected = candidates["original"]()
+    for name, candidate in candidates.items():
+        result = candidate()
+        if result != expected:
+            raise AssertionError("{} returned {}, expected {}".format(name, result, expected))
+
+    print("Parsed values: wh={} watts={} mi_online={}".format(*expected))
+    print("Bytes per cycle: html {}, json {}".format(len(production) + len(home),
+                                                     len(api_production) + len(production_json)))
+    baseline = None
+    for name, candidate in candidates.items():
+        per_call = timeit.timeit(candidate, number=args.number) / args.number
+        baseline = baseline or per_call
+        print("{:<16} {:>9.1f} us/cycle  {:>5.1f}x".format(name, per_call * 1e6, baseline / per_call))
+
+
+if __name__ == '__main__':
+    main()
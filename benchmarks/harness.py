@@ -0,0 +1,355 @@
+"""
+Stand-ins for everything the logger talks to, so a full run can be benchmarked on one machine.
+
+- StandInServer serves the recorded gateway pages, a weather endpoint and an IP lookup over real HTTP, with a
+  configurable delay on every response.
+- FakeSheetClient takes the place of gspread and counts the API calls that would have been made.
+- CompressedClock runs a day's worth of polling in a few seconds by scaling the time that sleeps and clocks see.
+"""
+import datetime
+import json
+import os
+import re
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+from unittest import mock
+
+from src.sheet_manager import column_index, column_letter
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+
+index_page = b"<html><head><title>Envoy</title></head><body>enphase energy</body></html>"
+
+
+def load_fixture(name: str) -> bytes:
+    with open(os.path.join(fixtures_dir, name), "rb") as f:
+        return f.read()
+
+
+class CompressedClock:
+    """
+    A clock that runs factor times faster than the real one.
+
+    Patched in place of the time module, it makes sleeps take 1/factor as long while time(), monotonic() and
+    localtime() move forward as if the whole sleep had happened. Anything it doesn't cover goes to the real module.
+    """
+
+    def __init__(self, factor: float = 60, start: float = None):
+        """
+        :param factor: How many simulated seconds pass for every real one
+        :param start: Simulated epoch time to start at. Defaults to now.
+        """
+        self.factor = factor
+        self._real_start = time.monotonic()
+        self._start = start if start is not None else time.time()
+
+    def time(self) -> float:
+        return self._start + (time.monotonic() - self._real_start) * self.factor
+
+    def monotonic(self) -> float:
+        return time.monotonic() * self.factor
+
+    def sleep(self, seconds: float):
+        time.sleep(max(0, seconds) / self.factor)
+
+    def localtime(self, secs: float = None):
+        return time.localtime(self.time() if secs is None else secs)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    @contextmanager
+    def patched(self, *modules):
+        """Use this clock in place of the time module in each of the given modules."""
+        patches = [mock.patch.object(module, "time", self) for module in modules]
+        for patch in patches:
+            patch.start()
+        try:
+            yield self
+        finally:
+            for patch in reversed(patches):
+                patch.stop()
+
+
+class GatewayPages:
+    """
+    The gateway's pages, with the production numbers moving on every refresh_period simulated seconds the way a
+    real Envoy's do.
+    """
+
+    def __init__(self, clock: CompressedClock, refresh_period: float = 600, microinverters: int = 24):
+        self.clock = clock
+        self.refresh_period = refresh_period
+        self.microinverters = microinverters
+
+        self._production = load_fixture("production.html")
+        self._home = load_fixture("home.html")
+
+    def generation(self) -> int:
+        return int(self.clock.time() // self.refresh_period)
+
+    def production(self) -> bytes:
+        generation = self.generation()
+        kw = 2 + (generation % 7) * 0.35
+        kwh = (generation % 144) * 0.4
+        page = re.sub(rb"[\d.]+ kWh", "{:.1f} kWh".format(kwh).encode(), self._production, count=1)
+        return re.sub(rb"[\d.]+ kW<", "{:.2f} kW<".format(kw).encode(), page, count=1)
+
+    def home(self) -> bytes:
+        return self._home
+
+    def _json_values(self) -> Tuple[int, float]:
+        generation = self.generation()
+        return int((generation % 144) * 400), 2000 + (generation % 7) * 350
+
+    def api_production(self) -> bytes:
+        wh, watts = self._json_values()
+        return json.dumps({"wattHoursToday": wh, "wattHoursSevenDays": wh * 7,
+                           "wattHoursLifetime": 42700000 + wh, "wattsNow": watts}).encode()
+
+    def production_json(self) -> bytes:
+        # readingTime is when the inverters last reported, so it only moves on a refresh
+        wh, watts = self._json_values()
+        return json.dumps({"production": [{"type": "inverters", "activeCount": self.microinverters,
+                                           "readingTime": self.generation() * int(self.refresh_period),
+                                           "wNow": watts,
+                                           "whLifetime": 42700000 + wh}],
+                           "consumption": [], "storage": []}).encode()
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    A local HTTP server with a response for each path. Every response is held back by latency seconds (real time),
+    and requests are counted by path.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0):
+        self.latency = latency
+        self.routes = {}  # type: Dict[str, Callable[[], Tuple[int, str, bytes]]]
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        self._thread = None
+        super(StandInServer, self).__init__((host, port), _StandInHandler)
+
+    @property
+    def address(self) -> str:
+        """host:port, for building urls."""
+        return "{}:{}".format(*self.server_address[:2])
+
+    def route(self, path: str, body: Callable[[], bytes], content_type: str = "text/html", status: int = 200):
+        """Serve whatever body() returns at path."""
+        self.routes[path] = lambda: (status, content_type, body())
+
+    def add_gateway(self, pages: GatewayPages, json_api: bool = True):
+        """Serve the gateway's pages. Leave out json_api to stand in for older firmware."""
+        self.route("/", lambda: index_page)
+        self.route("/home", pages.home)
+        self.route("/production", pages.production)
+        if json_api:
+            self.route("/api/v1/production", pages.api_production, "application/json")
+            self.route("/production.json", pages.production_json, "application/json")
+
+    def add_weather(self, cloud_cover: Callable[[], int] = lambda: 40):
+        self.route("/data/2.5/weather",
+                   lambda: json.dumps({"cod": 200, "clouds": {"all": cloud_cover()}}).encode(), "application/json")
+
+    def add_ip_lookup(self, ip: str = "203.0.113.7"):
+        self.route("/ip", lambda: ip.encode(), "text/plain")
+
+    def count(self, path: str):
+        with self._counts_lock:
+            self.counts[path] += 1
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="stand-in-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        self.server.count(path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        route = self.server.routes.get(path)
+        if route is None:
+            status, content_type, body = 404, "text/plain", b"Not found"
+        else:
+            status, content_type, body = route()
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FakeCell:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeWorksheet:
+    def __init__(self, client: "FakeSheetClient", title: str):
+        self._client = client
+        self.title = title
+        self.cells = {"F1": "1"}
+
+    def acell(self, rowcol: str) -> _FakeCell:
+        self._client.count("acell")
+        return _FakeCell(self.cells.get(rowcol))
+
+    def update_acell(self, rowcol: str, value):
+        self._client.count("update_acell")
+        self.cells[rowcol] = value
+
+    def col_values(self, col: int) -> list:
+        self._client.count("col_values")
+        letter = column_letter(col)
+        rows = sorted(int(rowcol[len(letter):]) for rowcol in self.cells
+                      if rowcol.startswith(letter) and rowcol[len(letter):].isdigit())
+        return [str(self.cells["{}{}".format(letter, row)]) for row in rows]
+
+
+class FakeSheetClient:
+    """
+    Takes the place of gspread's client and spreadsheet. Values are kept in memory, and every call that would
+    have been a Sheets API request is counted.
+    """
+
+    class WorksheetNotFound(Exception):
+        pass
+
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.worksheets = {"Sheet1": FakeWorksheet(self, "Sheet1")}
+
+    def count(self, call: str):
+        with self._lock:
+            self.calls[call] += 1
+
+    @property
+    def api_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def login(self):
+        self.count("login")
+
+    def open_by_url(self, url: str) -> "FakeSheetClient":
+        self.count("open_by_url")
+        return self
+
+    def get_worksheet(self, index: int) -> FakeWorksheet:
+        self.count("get_worksheet")
+        return list(self.worksheets.values())[index]
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.count("worksheet")
+        try:
+            return self.worksheets[title]
+        except KeyError:
+            raise self.WorksheetNotFound(title)
+
+    def add_worksheet(self, title: str, rows: int, cols: int) -> FakeWorksheet:
+        self.count("add_worksheet")
+        self.worksheets[title] = FakeWorksheet(self, title)
+        return self.worksheets[title]
+
+    def values_batch_update(self, body: dict):
+        self.count("values_batch_update")
+        for entry in body["data"]:
+            title, cell_range = entry["range"].rsplit("!", 1)
+            worksheet = self.worksheets[title[1:-1].replace("''", "'")]
+            # Ranges are either one cell or a block like A2:E40
+            col, row = re.match(r"([A-Z]+)(\d+)", cell_range).groups()
+            for i, values in enumerate(entry["values"]):
+                for j, value in enumerate(values):
+                    worksheet.cells[column_letter(column_index(col) + j) + str(int(row) + i)] = value
+
+
+class _FakeCredentials:
+    access_token = "bench"
+    access_token_expired = False
+
+    def __init__(self):
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    def refresh(self, http):
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+@contextmanager
+def fake_sheets(client: FakeSheetClient):
+    """Make SheetReaders created inside this block talk to client rather than Google."""
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    with mock.patch.object(gspread, "authorize", lambda credentials, *args, **kwargs: client), \
+            mock.patch.object(gspread, "WorksheetNotFound", FakeSheetClient.WorksheetNotFound), \
+            mock.patch.object(ServiceAccountCredentials, "from_json_keyfile_name",
+                              lambda *args, **kwargs: _FakeCredentials()):
+        yield client
+
+
+class StageTimer:
+    """
+    Times calls to methods on live objects, grouped into named stages.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)  # type: Dict[str, List[float]]
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def wrap(self, obj, name: str, stage: str):
+        """Replace obj.name with a version that records how long each call takes under stage."""
+        func = getattr(obj, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                with self._lock:
+                    self.errors[stage] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.durations[stage].append(elapsed)
+
+        setattr(obj, name, timed)
+
+    def summary(self) -> List[dict]:
+        rows = []
+        for stage, durations in self.durations.items():
+            ordered = sorted(durations)
+            rows.append({
+                "stage": stage,
+                "calls": len(ordered),
+                "errors": self.errors[stage],
+                "mean_ms": statistics.mean(ordered) * 1000,
+                "p50_ms": ordered[len(ordered) // 2] * 1000,
+                "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                "max_ms": ordered[-1] * 1000
+            })
+        return rows
@@ -1,7 +1,6 @@
 import httplib2
 
 __author__ = 'Matt'
-from lxml import html
 import sys, getopt
 import requests
 import logging
@@ -12,10 +11,10 @@ from urllib.error import URLError
 from datetime import datetime, timezone
 import time
 from logging.handlers import RotatingFileHandler
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import os
 
+from src.discovery import SubnetScanner
+
 dirname = os.path.dirname(__file__)
 # filename = os.path.join(dirname, 'relative/path/to/file/you/want')
 
@@ -99,12 +98,32 @@ creds_path = config_json["service_account_json"]
 sheet_url = config_json["chart_url"]
 
 json_path = os.path.join(dirname, creds_path)
-credentials = ServiceAccountCredentials.from_json_keyfile_name(json_path, scope)
-# credentials = SignedJwtAssertionCredentials(json_key['client_email'], json_key['private_key'], scope)
-gc = gspread.authorize(credentials)
-sh = gc.open_by_url(sheet_url)
-worksheet = sh.get_worksheet(0)
-last_pos = worksheet.acell('F1').value
+
+# Set up by connect_sheet(), so that importing this doesn't need the network.
+credentials = None
+gc = None
+sh = None
+worksheet = None
+
+
+def connect_sheet():
+    """
+    Authorize with Google and open the sheet, if we haven't already.
+    """
+    global credentials, gc, sh, worksheet
+    if worksheet is not None:
+        return worksheet
+
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(json_path, scope)
+    # credentials = SignedJwtAssertionCredentials(json_key['client_email'], json_key['private_key'], scope)
+    gc = gspread.authorize(credentials)
+    sh = gc.open_by_url(sheet_url)
+    worksheet = sh.get_worksheet(0)
+    return worksheet
+
 
 times_run = 0
 ip_address = "192.168.1.22"
@@ -143,16 +162,7 @@ def get_ip_address(tag="enphase", base_ip_range="192.168.1"):
     :return: IP address, or None if no IP can be found.
     """
 
-    for i in range(0, 256):
-        ip = "{}.{}".format(base_ip_range, i)
-        try:
-            response = requests.get('http://%s' % ip, timeout=2)
-            if re.search(tag, response.text):
-                return ip
-        except (requests.ConnectionError, requests.Timeout):
-            continue
-    else:
-        return None
+    return SubnetScanner(tag, base_ip_range).scan()
 
 
 def get_request(ip, path):
@@ -235,6 +245,7 @@ def init():
 
 
 def get_data_today(verbose):  # Get today's total usage in kWh
+    from lxml import html
     page = get_request(ip_address, "/production")  # Pull the webpage
     tree = html.fromstring(page.text)
     data = tree.xpath("/html/body/div[1]/table/tr[3]/td[2]/text()")  # Grab the value
@@ -257,6 +268,7 @@ def get_data_today(verbose):  # Get today's total usage in kWh
 
 
 def get_mi_status(verbose):  # Boolean
+    from lxml import html
     if verbose:
         log.info("Determining current solar cell status...")
     page = get_request(ip_address, "/home")
@@ -270,6 +282,7 @@ def get_mi_status(verbose):  # Boolean
 
 
 def get_current_w():
+    from lxml import html
     page = get_request(ip_address, "/production")
     # page = requests.get("http://%s/production" % ip_address)
     tree = html.fromstring(page.text)
@@ -296,7 +309,7 @@ def debug_loop():
     except:
         log.exception("Error occurred when connecting to local page")
     if not local_ip_works:
-        ip_address = worksheet.acell("J2").value
+        ip_address = connect_sheet().acell("J2").value
         local_internet_on(ip_address)  # If this crashes out it's fine
     internet_on()  # This, however, needs to work
     get_data_today(False)
@@ -352,6 +365,7 @@ def runningloop(debug):  # Main loop that runs and reports to the webserver [whi
     log.info("Setting things up with Google Docs...")
     log.info("Everything is ready, will now wait until sunset.")
     # working_cell = (last_pos)
+    connect_sheet()
     last_pos = worksheet.acell('F1').value
     sunset = False
     last_data = 0
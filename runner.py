@@ -1,7 +1,10 @@
 import datetime
 import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
 from enum import Enum
 import logging
 from logging.handlers import RotatingFileHandler
@@ -13,6 +16,17 @@ from src.sheet_manager import SheetReader
 from src.solar_reader import SolarReader
 from src.weather import WeatherData
 from src.csv_writer import CSVWriter
+from src.sqlite_writer import SQLiteWriter
+from src.upload_queue import UploadQueue
+from src.sessions import make_session
+from src.collector import AsyncCollector, CycleReading
+from src.sites import Site, load_sites
+from src.scheduler import PollScheduler
+from src.sun import SunTimes, sun_times, load_location
+from src.sampler import WattSampler
+from src.live_store import RecentSamples
+from src.live_api import LiveAPIServer
+from src import metrics
 
 log = logging.getLogger()
 
@@ -34,6 +48,22 @@ log.addHandler(stdout_handler)
 log = logging.getLogger()
 
 
+def connect_in_background(sheet_reader: SheetReader) -> threading.Thread:
+    """
+    Connect to the sheet on another thread, so that startup doesn't wait on it. If it fails, the reader will try
+    again when it's first used.
+    """
+    def connect():
+        try:
+            sheet_reader.connect()
+        except Exception:
+            log.exception("Couldn't connect to the sheet yet, will try again when it's needed.")
+
+    thread = threading.Thread(target=connect, name="sheet-connect", daemon=True)
+    thread.start()
+    return thread
+
+
 class State(Enum):
     SUNRISE_WAIT = 0
     SYS_ONLINE = 1
@@ -42,21 +72,62 @@ class State(Enum):
 
 class SolarData:
     def __init__(self, sheet_reader: SheetReader, solar_reader: SolarReader, weather_reader: WeatherData,
-                 csv_path: str = None):
+                 csv_path: str = None, upload_queue: UploadQueue = None, csv_options: dict = None,
+                 concurrent: bool = False, ip_session: requests.Session = None,
+                 location: Tuple[float, float] = None, sqlite_path: str = None, rollup_dir: str = None,
+                 site: str = "default", sample_interval: float = None, rollup_write_interval: float = 600,
+                 sqlite_batch_rows: int = 1):
         """
         Create a new solar processor class.
         :param sheet_reader: Sheet reader responsible for processing the excel sheet
         :param solar_reader: Solar reader responsible for parsing/accessing the solar panel web ui
         :param weather_reader:
         :param csv_path:
+        :param upload_queue: Optional write-behind queue for sheet rows. If not given, rows are written directly.
+        :param csv_options: Extra keyword arguments for the CSVWriter, like flush and rollover policy
+        :param concurrent: Gather each cycle's data from all sources at once, rather than one after another
+        :param ip_session: Optional session to share for external IP lookups
+        :param location: Optional (latitude, longitude) of the panels. If given, sunrise and solar noon are
+        calculated for it, rather than waiting on the microinverters and using the clock's noon.
+        :param sqlite_path: Optional path to a SQLite database to store rows in, alongside the csv file
+        :param rollup_dir: Optional directory to keep hourly, daily and monthly summaries of the readings in
+        :param site: Name of the site, for labelling metrics
+        :param sample_interval: If given, sample the current production this often (in seconds) between readings,
+        and add the minimum, maximum and mean watts and the energy generated since the last row to each row.
+        :param rollup_write_interval: How often, in seconds, to write the rollup tables and their state out. Rows
+        are added to the rollups as they come in, and anything left is written on close.
+        :param sqlite_batch_rows: Number of rows to buffer before inserting them into the SQLite database
         """
+        self.site = site
         self.sheet_reader = sheet_reader
+        self.upload_queue = upload_queue
         self.solar_reader = solar_reader
         self.weather_reader = weather_reader
 
         self.db_fields = ["timestamp", "wh", "mi_online", "cur_kw_output", "cloud_cover"]
 
-        self.database_writer = CSVWriter(csv_path, self.db_fields)
+        self.sampler = None
+        if sample_interval:
+            self.sampler = WattSampler(solar_reader.read_current_watts, sample_interval)
+            self.db_fields += ["watts_min", "watts_max", "watts_mean", "interval_wh"]
+
+        self.database_writer = CSVWriter(csv_path, self.db_fields, **(csv_options or {}))
+        self.sqlite_writer = (SQLiteWriter(sqlite_path, self.db_fields, batch_size=sqlite_batch_rows)
+                              if sqlite_path else None)
+
+        # The latest rows, for the live API
+        self.recent = RecentSamples()
+
+        self.rollup_dir = rollup_dir
+        self.rollups = None
+        if rollup_dir:
+            # numpy is only needed for rollups, so only import it if they're wanted
+            from src.rollup import RollupEngine
+            os.makedirs(rollup_dir, exist_ok=True)
+            self.rollups = RollupEngine(os.path.join(rollup_dir, "state.json"))
+        self.rollup_write_interval = rollup_write_interval
+        self._rollups_dirty = False
+        self._last_rollup_write = time.monotonic()
 
         self.state = State.SUNRISE_WAIT
 
@@ -64,14 +135,33 @@ class SolarData:
         self.mi_col = "C"
         self.cur_kw_col = "D"
         self.weather_col = "E"
+        # Only used with a sampler. J2 to L2 hold IP addresses, so the energy for the interval is only kept locally
+        # (column B already tracks energy on the sheet).
+        self.watts_min_col = "G"
+        self.watts_max_col = "H"
+        self.watts_mean_col = "I"
 
         self.ext_ip_cell = "K2"
 
+        self.ip_lookup_url = "https://api.ipify.org"
         self._prev_ip = None
+        self._ip_session = ip_session if ip_session is not None else make_session()
+        self.ip_timeout = (3.05, 10)
+
+        self.scheduler = PollScheduler()
+
+        self.location = location
+        # How long before sunrise to start checking the microinverters
+        self.sunrise_lead = datetime.timedelta(minutes=10)
+
+        self.collector = None
+        if concurrent:
+            self.collector = AsyncCollector(solar_reader, weather_reader, lambda: self._ip_address)
 
     @property
     def _ip_address(self):
-        ext_ip = requests.get("https://api.ipify.org").text
+        with metrics.time_stage("ext_ip"):
+            ext_ip = self._ip_session.get(self.ip_lookup_url, timeout=self.ip_timeout).text
         if ext_ip != self._prev_ip:
             log.info("IP address has changed to {}".format(ext_ip))
         self._prev_ip = ext_ip
@@ -89,24 +179,218 @@ class SolarData:
     #         self._prev_ip = ip
     #
 
+    def collect(self) -> CycleReading:
+        """
+        Gather this cycle's data from the solar system, weather and our external IP.
+        """
+        if self.collector is not None:
+            return self.collector.collect()
+
+        sample = self.solar_reader.get_snapshot()
+        if not sample.changed:
+            # Nothing will be written this cycle, so don't bother with the other sources either.
+            return CycleReading(sample.timestamp, sample.wh, sample.mi_online, sample.current_watts, None, None, False)
+
+        cloud_cover = self.weather_reader.get_cloud_levels()
+
+        try:
+            ext_ip = self._ip_address
+        except requests.RequestException:
+            log.warning("Couldn't determine our external IP address.")
+            ext_ip = None
+
+        return CycleReading(sample.timestamp, sample.wh, sample.mi_online, sample.current_watts, cloud_cover, ext_ip,
+                            sample.changed)
+
+    def sun_times(self) -> SunTimes:
+        """Today's sun events at our location. Only valid if a location was given."""
+        return sun_times(*self.location)
+
     def wait_on_sunrise(self):
         log.info("Waiting for sunrise...")
-        while not self.solar_reader.is_online():
+        if self.location is not None:
+            sunrise = self.sun_times().sunrise
+            if sunrise is not None:
+                wake_time = sunrise - self.sunrise_lead
+                delay = (wake_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                if delay > 0:
+                    log.info("Sunrise is at {}, sleeping until {}.".format(sunrise.strftime("%H:%M"),
+                                                                          wake_time.strftime("%H:%M")))
+                    time.sleep(delay)
+
+        while not self.is_online():
             # Check every 10 minutes to see if the solar system is online.
             time.sleep(600)
 
-    @staticmethod
-    def is_past_noon():
+    def is_online(self) -> bool:
+        """
+        Whether the solar system is up. A gateway that doesn't answer in time counts as not up yet, rather than
+        ending the run.
+        """
+        try:
+            return self.solar_reader.is_online()
+        except requests.RequestException:
+            log.warning("Couldn't reach the solar system, treating it as offline.", exc_info=True)
+            return False
+
+    def is_past_noon(self) -> bool:
+        """
+        Whether it's past solar noon at our location, or past 12 by the clock if we don't know where we are.
+        """
+        if self.location is not None:
+            return datetime.datetime.now(datetime.timezone.utc) > self.sun_times().noon
+
         dt = datetime.datetime.now()
 
         return dt.hour > 12
 
+    def poll_once(self) -> bool:
+        """
+        Run a single cycle: gather a reading and write it out.
+
+        :return: False once the system has gone offline for the night, True otherwise.
+        """
+        start = time.perf_counter()
+        try:
+            return self._poll_once()
+        finally:
+            metrics.cycle_duration.observe(time.perf_counter() - start, site=self.site)
+            metrics.registry.export()
+
+    def _poll_once(self) -> bool:
+        if self.sampler is not None:
+            self.sampler.start()
+
+        # One reading per cycle: the online check and the row we write both come from the same page fetches.
+        try:
+            reading = self.collect()
+        except Exception:
+            # A timeout, a failed rediscovery, a page we couldn't parse, or anything else the old loop would have
+            # carried on through. Try again next time, as if nothing changed.
+            log.exception("Couldn't read the solar system this cycle.")
+            self.scheduler.record(False)
+            return True
+        self.scheduler.record(reading.changed)
+        # If we couldn't tell how many microinverters are up, assume they still are rather than quit early.
+        online = reading.mi_online is None or reading.mi_online > 0
+        if not online and self.is_past_noon():
+            return False
+
+        if not online:
+            log.error("Solar system shows as offline yet it is still morning.")
+
+        if not reading.changed:
+            log.info("Solar system hasn't updated since the last reading, nothing to write.")
+            return True
+
+        metrics.last_sample_time.set(reading.timestamp, site=self.site)
+        try:
+            self.write_reading(reading)
+            metrics.rows_written.inc(site=self.site)
+            metrics.sample_age.set(time.time() - reading.timestamp, site=self.site)
+        except Exception:
+            log.exception("An exception occurred in the main loop.")
+        return True
+
+    def write_reading(self, reading: CycleReading):
+        """
+        Write a reading to the csv file and the sheet.
+        """
+        # Take note of our IP address as well, in the same request as the row
+        extra_cells = {}
+        if reading.ext_ip is not None:
+            extra_cells[self.ext_ip_cell] = reading.ext_ip
+
+        csv_row_data = {
+            "timestamp": reading.timestamp,
+            "wh": reading.wh,
+            "mi_online": reading.mi_online,
+            "cur_kw_output": reading.current_watts,
+            "cloud_cover": reading.cloud_cover
+        }
+
+        stats = self.sampler.take() if self.sampler is not None else None
+        if stats is not None:
+            csv_row_data.update(watts_min=stats.watts_min, watts_max=stats.watts_max, watts_mean=stats.watts_mean,
+                                interval_wh=stats.energy_wh)
+
+        # Local copy first, so a sheet failure can't cost us the sample.
+        self.database_writer.write_row(csv_row_data)
+        if self.sqlite_writer is not None:
+            self.sqlite_writer.write_row(csv_row_data)
+        if self.rollups is not None:
+            self.update_rollups(csv_row_data)
+        self.recent.add(csv_row_data)
+
+        row_data = {
+            self.wh_col: reading.wh,
+            self.mi_col: reading.mi_online,
+            self.cur_kw_col: reading.current_watts,
+            self.weather_col: reading.cloud_cover
+        }
+        if stats is not None:
+            row_data.update({
+                self.watts_min_col: stats.watts_min,
+                self.watts_max_col: stats.watts_max,
+                self.watts_mean_col: stats.watts_mean
+            })
+
+        if self.upload_queue is not None:
+            self.upload_queue.put(row_data, extra_cells, reading.timestamp)
+        else:
+            # The whole row goes out in one request.
+            self.sheet_reader.update_row(row_data, extra_cells=extra_cells,
+                                         timestamp=datetime.datetime.fromtimestamp(reading.timestamp))
+
+        log.info("Data written to Docs.")
+
+    def update_rollups(self, row_data: dict):
+        """
+        Add a row to the rollup tables. It's handed over directly, so the csv file doesn't need flushing and reading
+        back. The tables are written out every rollup_write_interval seconds rather than for every row.
+        """
+        try:
+            self.rollups.add_row(row_data)
+            self._rollups_dirty = True
+        except Exception:
+            log.exception("Failed to update rollups.")
+            return
+        if time.monotonic() - self._last_rollup_write >= self.rollup_write_interval:
+            self.write_rollups()
+
+    def write_rollups(self):
+        """Write out the rollup tables and their state, if any rows have been added since they last were."""
+        if self.rollups is None or not self._rollups_dirty:
+            return
+        self._last_rollup_write = time.monotonic()
+        try:
+            self.rollups.write_tables(self.rollup_dir)
+            self.rollups.save()
+            self._rollups_dirty = False
+        except Exception:
+            log.exception("Failed to write rollups.")
+
+    def close_writers(self):
+        """Flush and close the local data files."""
+        self.database_writer.close()
+        if self.sqlite_writer is not None:
+            self.sqlite_writer.close()
+        self.write_rollups()
+
+    def close(self):
+        """Stop sampling and gathering, and close the local data files."""
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.collector is not None:
+            self.collector.close()
+        self.close_writers()
+
     def main_loop(self):
         """
         Main running loop.
 
-        Every 10 minutes, the system will get the current status of the solar cells and
-        log it to the google spreadsheet.
+        Whenever the gateway refreshes (about every 10 minutes), the system will get the current status of the
+        solar cells and log it to the google spreadsheet. The scheduler works out when that is.
         If the number of microinverters drops to 0 (meaning sunset has happened), it exits out.
         """
 
@@ -115,53 +399,25 @@ class SolarData:
         # Once we detect some activity, stay up until at least the afternoon
 
         log.info("Entering main loop")
-        while self.solar_reader.is_online() or not self.is_past_noon():
-            if not self.is_past_noon() and not self.solar_reader.is_online():
-                log.error("Solar system shows as offline yet it is still morning.")
-            try:
-                cur_wh = self.solar_reader.get_wh_production()
-                cur_mis = self.solar_reader.get_mi_online()
-                cur_watts = self.solar_reader.get_current_watt_production()
-                cloud_cover = self.weather_reader.get_cloud_levels()
-
-                # Fill each data element in piecewise.
-                # Timestamp is handled within the function
-                self.sheet_reader.update_row({
-                    self.wh_col: cur_wh,
-                    self.mi_col: cur_mis,
-                    self.cur_kw_col: cur_watts,
-                    self.weather_col: cloud_cover
-                })
-
-                csv_row_data = {
-                    "timestamp": time.time(),
-                    "wh": cur_wh,
-                    "mi_online": cur_mis,
-                    "cur_kw_output": cur_watts,
-                    "cloud_cover": cloud_cover
-                }
-
-                self.database_writer.write_row(csv_row_data)
-
-                log.info("Data written to Docs.")
-
-                # Take note of our IP address as well
-                self.sheet_reader.write_cell(self.ext_ip_cell, self._ip_address)
-
-            except Exception:
-                log.exception("An exception occurred in the main loop.")
-            finally:
-                time.sleep(600)
+        while self.poll_once():
+            self.scheduler.wait()
 
         log.info("Solar system is offline. Signing off for the night.")
 
     def run(self):
         """Start up the system."""
         log.info("Started, initializing...")
+        try:
+            self._run()
+        finally:
+            # Even if something unexpected ends the day early, buffered rows still get written out
+            self.close()
+        log.info("Run call ending, program terminating.")
 
+    def _run(self):
         # Check to see if the system is online. If it is, then we'll start right up.
 
-        if self.solar_reader.is_online():
+        if self.is_online():
             log.info("Solar system online on startup.")
             self.main_loop()
 
@@ -178,7 +434,160 @@ class SolarData:
             else:
                 log.warning("Program was started after sunset. Shutting down.")
 
-        log.info("Run call ending, program terminating.")
+
+class MultiSiteRunner:
+    """
+    Polls many solar installations from one process.
+
+    Every site gets its own SolarData, writing to its own worksheet, csv file and upload queue, while the sheet
+    client, weather reader and http sessions are shared. Each site is polled when its own scheduler says its
+    gateway will have refreshed, with at most max_workers being polled at once.
+    """
+
+    def __init__(self, runners: Dict[str, SolarData], max_workers: int = 8, interval: float = 600):
+        """
+        :param runners: SolarData for each site, by site name
+        :param max_workers: Maximum number of sites polled at the same time
+        :param interval: Time between checks on a site that hasn't come online yet, in seconds. Once it's online,
+        its scheduler decides.
+        """
+        self.runners = runners
+        self.max_workers = max_workers
+        self.interval = interval
+
+        # Sites that have come online today
+        self._started = set()
+        # Monotonic time of the next check on each site that hasn't come online yet
+        self._next_check = {}
+
+    @classmethod
+    def from_sites(cls, sites: List[Site], sheet_reader: SheetReader, weather_reader: WeatherData, csv_path: str,
+                   queue_path: str = None, csv_options: dict = None, concurrent: bool = False,
+                   max_workers: int = 8, location: Tuple[float, float] = None,
+                   sqlite_path: str = None, rollup_dir: str = None, backend: str = "auto",
+                   sample_interval: float = None, discovery_cache: str = None,
+                   sqlite_batch_rows: int = 1) -> "MultiSiteRunner":
+        """
+        Set up a runner for each site. Sites whose gateway can't be reached are logged and left out.
+        Sites without their own latitude and longitude use location.
+
+        The sheet is connected to in the background, while the gateways are found and the weather is fetched at
+        the same time, so startup takes about as long as the slowest of them rather than all of them together.
+        """
+        gateway_session = make_session(pool_connections=max(len(sites), 1), pool_maxsize=2)
+        ip_session = make_session()
+
+        def site_path(path: str, name: str) -> str:
+            root, ext = os.path.splitext(path)
+            return "{}-{}{}".format(root, name, ext)
+
+        connect_in_background(sheet_reader)
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            executor.submit(weather_reader.get_cloud_levels)
+            reader_futures = {site.name: executor.submit(SolarReader, site.tag, site.address, site.static_ip,
+                                                         session=gateway_session, backend=backend,
+                                                         discovery_cache=site_path(discovery_cache, site.name)
+                                                         if discovery_cache else None)
+                              for site in sites}
+
+        runners = {}
+        for site in sites:
+            try:
+                solar_reader = reader_futures[site.name].result()
+            except Exception:
+                log.exception("Couldn't connect to site {}, it won't be polled.".format(site.name))
+                continue
+
+            site_sheet = sheet_reader.for_worksheet(site.worksheet)
+            upload_queue = None
+            if queue_path:
+                upload_queue = UploadQueue(site_sheet, site_path(queue_path, site.name))
+
+            site_location = location
+            if site.latitude is not None and site.longitude is not None:
+                site_location = (site.latitude, site.longitude)
+
+            runners[site.name] = SolarData(site_sheet, solar_reader, weather_reader,
+                                           site_path(csv_path, site.name), upload_queue, csv_options,
+                                           concurrent=concurrent, ip_session=ip_session, location=site_location,
+                                           sqlite_path=site_path(sqlite_path, site.name) if sqlite_path else None,
+                                           rollup_dir=os.path.join(rollup_dir, site.name) if rollup_dir else None,
+                                           site=site.name, sample_interval=sample_interval,
+                                           sqlite_batch_rows=sqlite_batch_rows)
+
+        return cls(runners, max_workers)
+
+    def _poll_site(self, name: str, runner: SolarData) -> bool:
+        """
+        Poll one site.
+        :return: Whether the site should keep being polled today
+        """
+        if name not in self._started:
+            if runner.location is not None:
+                sunrise = runner.sun_times().sunrise
+                if sunrise is not None and datetime.datetime.now(datetime.timezone.utc) < sunrise - runner.sunrise_lead:
+                    # Too early to bother the gateway
+                    return True
+
+            if not runner.solar_reader.is_online():
+                if runner.is_past_noon():
+                    log.warning("Site {} is offline and it's past noon, skipping it today.".format(name))
+                    return False
+                # Still waiting on sunrise here
+                return True
+            log.info("Site {} is online.".format(name))
+            self._started.add(name)
+
+        return runner.poll_once()
+
+    def _seconds_until_due(self, name: str, runner: SolarData) -> float:
+        if name not in self._started:
+            # The scheduler has nothing to go on until the site is online
+            return max(0, self._next_check.get(name, 0) - time.monotonic())
+        return runner.scheduler.seconds_until_next()
+
+    def run(self):
+        """Poll every site until they've all gone offline for the night."""
+        active = dict(self.runners)
+        for runner in active.values():
+            if runner.upload_queue is not None:
+                runner.upload_queue.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while active:
+                    due = [name for name, runner in active.items() if self._seconds_until_due(name, runner) <= 0]
+                    futures = {executor.submit(self._poll_site, name, active[name]): name for name in due}
+
+                    for future in as_completed(futures):
+                        name = futures[future]
+                        try:
+                            keep_polling = future.result()
+                        except Exception:
+                            log.exception("Failed to poll site {}.".format(name))
+                            keep_polling = True
+                            if name in self._started:
+                                # Don't retry straight away
+                                active[name].scheduler.record(False)
+
+                        if name not in self._started:
+                            self._next_check[name] = time.monotonic() + self.interval
+
+                        if not keep_polling:
+                            log.info("Site {} is offline. Signing off for the night.".format(name))
+                            del active[name]
+
+                    if active:
+                        # Sleep until the next site is due
+                        time.sleep(min(self._seconds_until_due(name, runner) for name, runner in active.items()))
+        finally:
+            for runner in self.runners.values():
+                runner.close()
+                if runner.upload_queue is not None:
+                    runner.upload_queue.stop()
+                runner.sheet_reader.close()
+
+        log.info("All sites are offline, program terminating.")
 
 
 if __name__ == '__main__':
@@ -194,12 +603,180 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output", help="Path to the output .csv file",
                         type=str, default="output.csv")
 
-    args = parser.parse_args()
+    parser.add_argument("-q", "--queue", help="Path to the spool file for rows waiting to be uploaded to the sheet",
+                        type=str, default="upload_queue.jsonl")
+
+    parser.add_argument("--csv-flush-rows", help="Number of rows to buffer before flushing the .csv file",
+                        type=int, default=1)
+
+    parser.add_argument("--csv-flush-interval", help="Flush the .csv file if this many seconds have passed",
+                        type=float, default=None)
+
+    parser.add_argument("--csv-fsync", help="fsync the .csv file on every flush", action="store_true")
 
-    # TODO Convert some of these into command line args
-    sheet_reader = SheetReader()
-    solar_reader = SolarReader("enphase", args.address)
-    weather = WeatherData()
+    parser.add_argument("--csv-daily", help="Start a new .csv file every day", action="store_true")
+
+    parser.add_argument("--discovery-cache", help="File to remember where the gateway was found in, so it can "
+                                                  "usually be found again without scanning the network",
+                        type=str, default="discovery_cache.json")
+
+    parser.add_argument("-m", "--mode", help="serial: read each source in turn. async: read all sources at once, "
+                                             "writing whatever arrived before each source's timeout",
+                        choices=["serial", "async"], default="serial")
+
+    parser.add_argument("--sqlite", help="Path to a SQLite database to also store rows in",
+                        type=str, default=None)
+
+    parser.add_argument("--sqlite-batch-rows", help="Number of rows to buffer before inserting them into the "
+                                                    "SQLite database", type=int, default=1)
+
+    parser.add_argument("-s", "--sites", help="Poll every site listed under \"sites\" in the config file, "
+                                              "each writing to its own worksheet",
+                        action="store_true")
+
+    parser.add_argument("--max-workers", help="Maximum number of sites to poll at the same time",
+                        type=int, default=8)
+
+    parser.add_argument("--rollup-dir", help="Keep hourly, daily and monthly summary tables in this directory",
+                        type=str, default=None)
+
+    parser.add_argument("-b", "--backend", help="How to read the gateway. json: its JSON API. html: its web pages. "
+                                                "auto: the JSON API if it has one.",
+                        choices=SolarReader.backends, default="auto")
+
+    parser.add_argument("--sample-interval", help="Also sample the current production every this many seconds, "
+                                                  "adding its min, max, mean and energy to each row. This adds "
+                                                  "columns, so an existing .csv file without them is moved aside.",
+                        type=float, default=None)
+
+    parser.add_argument("--api-port", help="Serve recent readings as JSON on this port, under /api",
+                        type=int, default=None)
+
+    parser.add_argument("--api-host", help="Address for the JSON API to listen on. Defaults to all of them.",
+                        type=str, default="")
+
+    parser.add_argument("--metrics-file", help="Write Prometheus metrics to this file after every cycle, for "
+                                               "node_exporter's textfile collector", type=str, default=None)
+
+    parser.add_argument("--metrics-port", help="Serve Prometheus metrics on this port at /metrics",
+                        type=int, default=None)
+
+    subparsers = parser.add_subparsers(dest="command", help="Run one of these instead of polling")
+
+    rollup_parser = subparsers.add_parser("rollup", help="Build hourly, daily and monthly summary tables from "
+                                                         "csv history")
+    rollup_parser.add_argument("csv_files", help="History .csv files, oldest first", nargs="+")
+    rollup_parser.add_argument("--out-dir", help="Directory to write the tables to", type=str, default="rollups")
+
+    history_parser = subparsers.add_parser("history", help="Print the rows of a history .csv file in a time range")
+    history_parser.add_argument("csv_file", help="History .csv file")
+    history_parser.add_argument("--start", help="Start of the range: epoch seconds, an ISO date/time, or a duration "
+                                                "back from now like 7d or 12h", type=str, default=None)
+    history_parser.add_argument("--end", help="End of the range, in the same formats as --start",
+                                type=str, default=None)
+
+    backfill_parser = subparsers.add_parser("backfill", help="Upload csv history rows that are missing from the sheet")
+    backfill_parser.add_argument("csv_files", help="History .csv files, oldest first", nargs="+")
+    backfill_parser.add_argument("--worksheet", help="Title of the tab to fill in, if not the first one",
+                                 type=str, default=None)
+    backfill_parser.add_argument("--chunk-rows", help="Number of rows to send in each request",
+                                 type=int, default=500)
+    backfill_parser.add_argument("--requests-per-minute", help="Most write requests to make in a minute",
+                                 type=float, default=50)
+    backfill_parser.add_argument("--dry-run", help="Only count the rows that would be uploaded",
+                                 action="store_true")
+
+    args = parser.parse_args()
 
-    solar_runner = SolarData(sheet_reader, solar_reader, weather, args.output)
-    solar_runner.run()
+    if args.command == "backfill":
+        from src.backfill import SheetBackfill
+
+        backfill_sheet = SheetReader(args.config)
+        if args.worksheet:
+            backfill_sheet = backfill_sheet.for_worksheet(args.worksheet)
+        try:
+            SheetBackfill(backfill_sheet, args.csv_files, chunk_rows=args.chunk_rows,
+                          requests_per_minute=args.requests_per_minute).run(args.dry_run)
+        finally:
+            backfill_sheet.close()
+        sys.exit()
+
+    if args.command == "history":
+        from src.history import HistoryReader, parse_time
+
+        history = HistoryReader(args.csv_file)
+        start = parse_time(args.start) if args.start else None
+        end = parse_time(args.end) if args.end else None
+        lines = history.raw_lines(start, end)
+        # The header is only known once the file has been opened
+        first = next(lines, None)
+        sys.stdout.write(",".join(history.fields) + "\n")
+        if first is not None:
+            sys.stdout.buffer.write(first + b"\n")
+            for line in lines:
+                sys.stdout.buffer.write(line + b"\n")
+        sys.exit()
+
+    if args.command == "rollup":
+        from src.rollup import RollupEngine
+
+        os.makedirs(args.out_dir, exist_ok=True)
+        engine = RollupEngine(os.path.join(args.out_dir, "state.json"))
+        for csv_file in args.csv_files:
+            log.info("Added {} new rows from {}".format(engine.update_from_csv(csv_file), csv_file))
+        engine.write_tables(args.out_dir)
+        engine.save()
+        sys.exit()
+
+    metrics.registry.export_path = args.metrics_file
+    if args.metrics_port is not None:
+        metrics.registry.serve(args.metrics_port)
+
+    csv_options = {
+        "persistent": True,
+        "flush_rows": args.csv_flush_rows,
+        "flush_interval": args.csv_flush_interval,
+        "fsync": args.csv_fsync,
+        "rollover": args.csv_daily
+    }
+
+    if args.sites:
+        multi_runner = MultiSiteRunner.from_sites(load_sites(args.config), SheetReader(args.config),
+                                                  WeatherData(args.config), args.output, args.queue, csv_options,
+                                                  concurrent=args.mode == "async", max_workers=args.max_workers,
+                                                  location=load_location(args.config), sqlite_path=args.sqlite,
+                                                  rollup_dir=args.rollup_dir, backend=args.backend,
+                                                  sample_interval=args.sample_interval,
+                                                  discovery_cache=args.discovery_cache,
+                                                  sqlite_batch_rows=args.sqlite_batch_rows)
+        if args.api_port is not None:
+            LiveAPIServer({name: runner.recent for name, runner in multi_runner.runners.items()},
+                          args.api_port, args.api_host).start()
+        multi_runner.run()
+    else:
+        # TODO Convert some of these into command line args
+        sheet_reader = SheetReader()
+        weather = WeatherData()
+
+        # Rows go through the upload queue, so the first sample doesn't need to wait on the sheet. Finding the
+        # gateway and fetching the weather don't depend on each other, so do them at the same time.
+        connect_in_background(sheet_reader)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(weather.get_cloud_levels)
+            solar_reader = executor.submit(SolarReader, "enphase", args.address, backend=args.backend,
+                                          discovery_cache=args.discovery_cache).result()
+
+        upload_queue = UploadQueue(sheet_reader, args.queue)
+        upload_queue.start()
+
+        solar_runner = SolarData(sheet_reader, solar_reader, weather, args.output, upload_queue, csv_options,
+                                 concurrent=args.mode == "async", location=load_location(args.config),
+                                 sqlite_path=args.sqlite, rollup_dir=args.rollup_dir,
+                                 sample_interval=args.sample_interval, sqlite_batch_rows=args.sqlite_batch_rows)
+        if args.api_port is not None:
+            LiveAPIServer({solar_runner.site: solar_runner.recent}, args.api_port, args.api_host).start()
+        try:
+            solar_runner.run()
+        finally:
+            upload_queue.stop()
+            sheet_reader.close()
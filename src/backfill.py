@@ -0,0 +1,129 @@
+import datetime
+import logging
+import time
+from typing import Iterator, List
+
+from src.history import HistoryReader
+from src.sheet_manager import SheetReader, ts_format
+
+log = logging.getLogger()
+
+# Sheet columns after the timestamp in A, in order, and the csv field that goes in each
+default_columns = ["wh", "mi_online", "cur_kw_output", "cloud_cover"]
+
+
+class SheetBackfill:
+    """
+    Uploads rows from the csv history that never made it to the sheet.
+
+    The last timestamp on the sheet marks where it fell behind. Everything in the csv files after that (and not
+    already on the sheet) is appended in large blocks, a single request each, spaced out to stay under the Sheets
+    API's write quota. The position counter is written once, after the last block.
+    """
+
+    def __init__(self, sheet_reader: SheetReader, csv_paths: List[str], columns: List[str] = None,
+                 chunk_rows: int = 500, requests_per_minute: float = 50, max_retries: int = 5):
+        """
+        :param sheet_reader: Reader for the tab to fill in
+        :param csv_paths: History csv files, oldest first
+        :param columns: csv fields to write to columns B onwards
+        :param chunk_rows: Number of rows to send in each request
+        :param requests_per_minute: Most write requests to make in a minute
+        :param max_retries: How many times to retry a block that hits the rate limit
+        """
+        self.sheet_reader = sheet_reader
+        self.csv_paths = csv_paths
+        self.columns = columns or default_columns
+        self.chunk_rows = chunk_rows
+        self.min_interval = 60 / requests_per_minute
+        self.max_retries = max_retries
+
+        self._last_request = None
+
+    def sheet_timestamps(self) -> List[datetime.datetime]:
+        """Timestamps of the rows already on the sheet. Anything in column A that isn't one (a header) is skipped."""
+        timestamps = []
+        for value in self.sheet_reader.column_values(self.sheet_reader.ts_col):
+            try:
+                timestamps.append(datetime.datetime.strptime(value, ts_format))
+            except ValueError:
+                continue
+        return timestamps
+
+    def missing_rows(self) -> Iterator[list]:
+        """
+        Rows from the csv history that come after the last one on the sheet, ready to be written from column A.
+        """
+        on_sheet = self.sheet_timestamps()
+        start = None
+        seen = set()
+        if on_sheet:
+            last = max(on_sheet)
+            # The sheet only keeps whole seconds
+            start = last.timestamp()
+            seen = {timestamp for timestamp in on_sheet if timestamp >= last}
+            log.info("Sheet has {} rows, the last from {}.".format(len(on_sheet), last.strftime(ts_format)))
+        else:
+            log.info("Sheet has no rows yet.")
+
+        for csv_path in self.csv_paths:
+            for row in HistoryReader(csv_path).rows(start):
+                timestamp = datetime.datetime.fromtimestamp(row["timestamp"]).replace(microsecond=0)
+                if timestamp in seen:
+                    continue
+                yield [timestamp.strftime(ts_format)] + ["" if row.get(name) is None else row[name]
+                                                         for name in self.columns]
+
+    def _pace(self):
+        """Wait until we're allowed to make the next request."""
+        if self._last_request is not None:
+            delay = self.min_interval - (time.monotonic() - self._last_request)
+            if delay > 0:
+                time.sleep(delay)
+        self._last_request = time.monotonic()
+
+    def _send(self, rows: List[list]):
+        from gspread.exceptions import APIError
+
+        delay = self.min_interval
+        for attempt in range(self.max_retries + 1):
+            self._pace()
+            try:
+                self.sheet_reader.append_block(rows, update_pos=False)
+                return
+            except APIError as e:
+                if e.response.status_code != 429 or attempt == self.max_retries:
+                    raise
+                delay = min(delay * 2, 120)
+                log.warning("Hit the Sheets rate limit, backing off for {:.0f}s.".format(delay))
+                time.sleep(delay)
+
+    def run(self, dry_run: bool = False) -> int:
+        """
+        Upload the missing rows.
+        :param dry_run: Only count the rows that would be uploaded
+        :return: Number of rows uploaded
+        """
+        start_pos = self.sheet_reader.cur_pos
+        sent = 0
+        chunk = []
+        try:
+            for row in self.missing_rows():
+                chunk.append(row)
+                if len(chunk) == self.chunk_rows:
+                    if not dry_run:
+                        self._send(chunk)
+                    sent += len(chunk)
+                    log.info("{} rows backfilled so far.".format(sent))
+                    chunk = []
+            if chunk:
+                if not dry_run:
+                    self._send(chunk)
+                sent += len(chunk)
+        finally:
+            # Even if we stopped partway, the counter should point after the last block that made it
+            if not dry_run and self.sheet_reader.cur_pos != start_pos:
+                self.sheet_reader.cur_pos = self.sheet_reader.cur_pos
+
+        log.info("{} {} rows to the sheet.".format("Would have backfilled" if dry_run else "Backfilled", sent))
+        return sent
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Callable
+
+from src.solar_reader import SolarReader
+from src.weather import WeatherData, WeatherAPIError
+
+log = logging.getLogger()
+
+
+class CycleReading(NamedTuple):
+    """Everything gathered in one pass of the main loop. Values that couldn't be read in time are None."""
+    timestamp: float
+    wh: int
+    mi_online: int
+    current_watts: float
+    cloud_cover: float
+    ext_ip: str
+    # Whether the gateway had anything new for us this cycle
+    changed: bool = True
+
+
+class AsyncCollector:
+    """
+    Gathers the gateway pages, weather and external IP at the same time.
+
+    Each source has its own timeout, and the reading is assembled from whatever came back in time, so a cycle
+    takes as long as the slowest source rather than all of them added together.
+    """
+
+    default_timeouts = {
+        "production": 15,
+        "home": 15,
+        "weather": 10,
+        "ext_ip": 10
+    }
+
+    def __init__(self, solar_reader: SolarReader, weather_reader: WeatherData, ip_lookup: Callable[[], str],
+                 timeouts: dict = None):
+        """
+        :param solar_reader: Solar reader to get the gateway pages from
+        :param weather_reader: Weather reader to get cloud cover from
+        :param ip_lookup: Function returning our external IP address
+        :param timeouts: Per-source timeouts in seconds, overriding default_timeouts
+        """
+        self.solar_reader = solar_reader
+        self.weather_reader = weather_reader
+        self.ip_lookup = ip_lookup
+
+        self.timeouts = dict(self.default_timeouts)
+        self.timeouts.update(timeouts or {})
+
+        # The clients are all blocking, so each source gets a worker thread.
+        self._executor = ThreadPoolExecutor(max_workers=len(self.timeouts))
+
+    def _read_production(self) -> tuple:
+        # The second call is answered from the reader's page cache.
+        return self.solar_reader.get_wh_production(), self.solar_reader.get_current_watt_production()
+
+    async def _run(self, name: str, func: Callable):
+        """Run a blocking source in the executor, returning None if it fails or runs out of time."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self._executor, func), self.timeouts[name])
+        except asyncio.TimeoutError:
+            log.warning("Timed out after {}s reading {}.".format(self.timeouts[name], name))
+        except (Exception, WeatherAPIError):
+            log.exception("Failed to read {}.".format(name))
+        return None
+
+    async def collect_async(self) -> CycleReading:
+        production, mi_online, cloud_cover, ext_ip = await asyncio.gather(
+            self._run("production", self._read_production),
+            self._run("home", self.solar_reader.get_mi_online),
+            self._run("weather", self.weather_reader.get_cloud_levels),
+            self._run("ext_ip", self.ip_lookup)
+        )
+        wh, current_watts = production if production is not None else (None, None)
+        # Same checks as a serial reading, so an unchanged, old or partial page isn't written as a new row
+        sample = self.solar_reader.record_reading(wh, mi_online, current_watts)
+
+        return CycleReading(sample.timestamp, sample.wh, sample.mi_online, sample.current_watts, cloud_cover, ext_ip,
+                            sample.changed)
+
+    def collect(self) -> CycleReading:
+        """Gather one reading from every source concurrently."""
+        return asyncio.run(self.collect_async())
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -1,15 +1,148 @@
 import csv
+import datetime
+import logging
+import os
+import time
 from typing import List
 
+from src.metrics import timed
+
+log = logging.getLogger()
+
 
 class CSVWriter:
+    """
+    Appends rows to a csv file, writing a header whenever it starts a new file. An existing file whose header
+    doesn't match our fields (from before columns were added) is renamed out of the way rather than appended to.
 
-    def __init__(self, csv_path: str, fields: List[str]):
+    By default the file is opened and closed for every row. In persistent mode the handle stays open, and rows are
+    flushed once flush_rows rows have built up or flush_interval seconds have passed, whichever comes first.
+    """
+
+    def __init__(self, csv_path: str, fields: List[str], persistent: bool = False, flush_rows: int = 1,
+                 flush_interval: float = None, fsync: bool = False, rollover: bool = False):
+        """
+        :param csv_path: Path to the csv file
+        :param fields: Column names, in order
+        :param persistent: Keep the file open between rows
+        :param flush_rows: In persistent mode, flush after this many rows
+        :param flush_interval: In persistent mode, flush if a row comes in this many seconds after the last flush
+        :param fsync: Also fsync the file on every flush, so rows survive a power cut
+        :param rollover: Start a new file every day, named like output-2020-06-01.csv
+        """
         self.file_path = csv_path
         self.fields = fields
+        self.persistent = persistent
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rollover = rollover
+
+        self._file = None
+        self._writer = None
+        self._open_path = None
+        # Files whose header we've already checked
+        self._checked_paths = set()
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def current_path(self) -> str:
+        """The file that rows are currently being written to."""
+        if not self.rollover:
+            return self.file_path
+        root, ext = os.path.splitext(self.file_path)
+        return "{}-{}{}".format(root, datetime.date.today().isoformat(), ext)
+
+    def _check_header(self, path: str):
+        """
+        Move the file at path aside if its header isn't ours, so rows never end up under the wrong columns. Files
+        from before we wrote headers at all are kept as long as their rows are as wide as ours.
+        """
+        if path in self._checked_paths:
+            return
+        self._checked_paths.add(path)
+        try:
+            with open(path, "r", newline="") as f:
+                header = next(csv.reader(f), None)
+        except FileNotFoundError:
+            return
+        if header is None or header == self.fields:
+            return
+        has_header = header[:1] == self.fields[:1]
+        if not has_header and len(header) == len(self.fields):
+            # No header, just rows that fit ours
+            return
+
+        root, ext = os.path.splitext(path)
+        old_path = "{}-{}{}".format(root, time.strftime("%Y%m%d-%H%M%S"), ext)
+        os.replace(path, old_path)
+        if has_header:
+            log.warning("{} has columns {}, not {}. Moved it to {} and starting a new file."
+                        .format(path, ", ".join(header), ", ".join(self.fields), old_path))
+        else:
+            log.warning("{} has no header and rows {} columns wide, not {}. Moved it to {} and starting a new file."
+                        .format(path, len(header), len(self.fields), old_path))
+
+    def _open(self, path: str):
+        self._check_header(path)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        f = open(path, "a", newline="")
+        writer = csv.DictWriter(f, self.fields)
+        if new_file:
+            writer.writeheader()
+        return f, writer
 
+    @timed("csv")
     def write_row(self, row_data: dict):
-        with open(self.file_path, "a") as f:
+        if not self.persistent:
+            f, writer = self._open(self.current_path)
+            with f:
+                writer.writerow(row_data)
+                self._sync(f)
+            return
+
+        path = self.current_path
+        if path != self._open_path:
+            # First row, or the day has rolled over
+            self.close()
+            self._file, self._writer = self._open(path)
+            self._open_path = path
+
+        self._writer.writerow(row_data)
+        self._unflushed += 1
+
+        interval_passed = (self.flush_interval is not None
+                           and time.monotonic() - self._last_flush >= self.flush_interval)
+        if self._unflushed >= self.flush_rows or interval_passed:
+            self.flush()
+
+    def _sync(self, f):
+        if self.fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def flush(self):
+        """Push any buffered rows out to the file."""
+        if self._file is None:
+            return
+        self._file.flush()
+        self._sync(self._file)
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Flush and close the file, if it's open."""
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+        self._writer = None
+        self._open_path = None
+
+    def __enter__(self):
+        return self
 
-            writer = csv.DictWriter(f, self.fields)
-            writer.writerow(row_data)
\ No newline at end of file
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,193 @@
+import json
+import os
+import re
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+
+import requests
+
+log = logging.getLogger()
+
+arp_table_path = "/proc/net/arp"
+
+
+def read_arp_table(path: str = arp_table_path) -> dict:
+    """
+    Read the kernel's neighbour table.
+    :return: Dict of MAC address (lower case) to IP address, for complete entries only. Empty if it can't be read.
+    """
+    table = {}
+    try:
+        with open(path, "r") as f:
+            next(f, None)  # Header
+            for line in f:
+                parts = line.split()
+                if len(parts) < 4:
+                    continue
+                ip, flags, mac = parts[0], parts[2], parts[3].lower()
+                # 0x2 is a complete entry. Incomplete ones have no real MAC address.
+                if int(flags, 16) & 0x2 and mac != "00:00:00:00:00:00":
+                    table[mac] = ip
+    except (OSError, ValueError):
+        pass
+    return table
+
+
+class DiscoveryCache:
+    """
+    Remembers where the device was last found, and its MAC address, in a small json file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ip = None
+        self.mac = None
+
+        try:
+            with open(path, "r") as f:
+                cached = json.load(f)
+            self.ip = cached.get("ip")
+            self.mac = cached.get("mac")
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError):
+            log.warning("Ignoring unreadable discovery cache at {}".format(path))
+
+    def save(self, ip: str, mac: str = None):
+        self.ip = ip
+        # Keep the MAC address we knew if we couldn't see it this time, it doesn't change
+        self.mac = mac or self.mac
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"ip": self.ip, "mac": self.mac, "found": time.time()}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            log.exception("Couldn't save the discovery cache.")
+
+
+class SubnetScanner:
+    """
+    Finds the solar web interface on the local network.
+
+    Every host in the range is probed at once (bounded by max_workers), and the first host whose
+    page contains our tag wins. The whole scan is bounded by a deadline, so a missing device costs
+    us a few seconds rather than minutes.
+    """
+
+    def __init__(self, tag: str, base_ip_range: str, max_workers: int = 64, probe_timeout: float = 2,
+                 deadline: float = 15, hosts: range = range(1, 255), port: int = None, cache_path: str = None):
+        """
+        :param tag: Regex pattern to look for on a host's index page.
+        :param base_ip_range: Base of the ip addresses to search, of the form xxx.xxx.xxx.
+        :param max_workers: Maximum number of hosts probed at the same time.
+        :param probe_timeout: Timeout for each individual probe, in seconds.
+        :param deadline: Maximum time the whole scan may take, in seconds.
+        :param hosts: Last octets to probe.
+        :param port: Port the web interface listens on, if not 80.
+        :param cache_path: Optional file to remember the device's address in, so locate() can usually skip the
+        scan.
+        """
+        self._tag = re.compile(tag)
+        self._base_ip_range = base_ip_range
+        self.max_workers = max_workers
+        self.probe_timeout = probe_timeout
+        self.deadline = deadline
+        self.hosts = hosts
+        self.port = port
+        self.cache = DiscoveryCache(cache_path) if cache_path else None
+        self.arp_table_path = arp_table_path
+
+        # Duration of the most recent scans, in seconds.
+        self.durations = deque(maxlen=20)
+
+    @property
+    def last_duration(self) -> float:
+        """Time taken by the most recent scan, or None if we haven't scanned yet."""
+        return self.durations[-1] if self.durations else None
+
+    def _probe(self, ip: str) -> bool:
+        """Check a single host for our tag."""
+        try:
+            host = ip if self.port is None else "{}:{}".format(ip, self.port)
+            response = requests.get("http://{}".format(host), timeout=self.probe_timeout)
+        except requests.RequestException:
+            return False
+        return bool(self._tag.search(response.text))
+
+    def scan(self) -> str:
+        """
+        Scan the subnet for the device.
+
+        :return: IP address of the first host whose page matches our tag, or None if nothing matched in time.
+        """
+        start = time.monotonic()
+        found = None
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {}
+        try:
+            for i in self.hosts:
+                ip = "{}.{}".format(self._base_ip_range, i)
+                futures[executor.submit(self._probe, ip)] = ip
+
+            for future in as_completed(futures, timeout=self.deadline):
+                if future.result():
+                    found = futures[future]
+                    break
+        except FutureTimeoutError:
+            log.warning("Subnet scan of {}.x hit its {}s deadline.".format(self._base_ip_range, self.deadline))
+        finally:
+            # Anything still queued is no longer needed. Probes already in flight will end on their own timeout.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        elapsed = time.monotonic() - start
+        self.durations.append(elapsed)
+        log.info("Subnet scan of {}.x took {:.2f}s, found {}".format(self._base_ip_range, elapsed, found))
+
+        return found
+
+    def _mac_for(self, ip: str) -> str:
+        for mac, table_ip in read_arp_table(self.arp_table_path).items():
+            if table_ip == ip:
+                return mac
+        return None
+
+    def locate(self, skip: str = None) -> str:
+        """
+        Find the device, trying the cheap ways first. These are the address it was last found at, then wherever the
+        kernel's neighbour table says its MAC address is now. A scan of the subnet is the last resort. Whatever
+        is found is remembered for next time.
+
+        :param skip: An address known not to work (the one that just failed), which isn't worth probing again.
+        :return: IP address of the device, or None if it couldn't be found.
+        """
+        if self.cache is None:
+            return self.scan()
+
+        candidates = []
+        if self.cache.ip:
+            candidates.append(("cached address", self.cache.ip))
+        if self.cache.mac:
+            arp_ip = read_arp_table(self.arp_table_path).get(self.cache.mac)
+            if arp_ip:
+                candidates.append(("neighbour table", arp_ip))
+
+        tried = {skip}
+        for source, ip in candidates:
+            if ip in tried:
+                continue
+            tried.add(ip)
+            if self._probe(ip):
+                log.info("Found the device at {} from the {}.".format(ip, source))
+                self.cache.save(ip, self._mac_for(ip))
+                return ip
+
+        found = self.scan()
+        if found is not None:
+            self.cache.save(found, self._mac_for(found))
+        return found
@@ -0,0 +1,56 @@
+import json
+import logging
+from typing import Tuple
+
+from src.metrics import timed
+
+log = logging.getLogger()
+
+# Production totals, on every firmware that has the JSON API
+production_api_path = "/api/v1/production"
+# Per-device-type readings, including how many microinverters are reporting
+production_json_path = "/production.json"
+
+
+def _load(content: bytes) -> dict:
+    try:
+        return json.loads(content)
+    except ValueError as e:
+        raise ValueError("Gateway didn't send valid JSON, it may not have the JSON API.") from e
+
+
+class EnvoyJSONParser:
+    """
+    Pulls values out of the Envoy's JSON endpoints. These are much smaller than the html pages and need no tree to
+    read, but older firmware doesn't have them.
+    """
+
+    @timed("parse")
+    def parse_production(self, content: bytes) -> Tuple[int, float, int]:
+        """
+        Read /api/v1/production.
+        :param content: Raw response body
+        :return: Energy generated today and in total in watt-hours, and current production in watts
+        """
+        production = _load(content)
+        try:
+            return (int(production["wattHoursToday"]), float(production["wattsNow"]),
+                    int(production["wattHoursLifetime"]))
+        except (KeyError, TypeError) as e:
+            raise ValueError("Couldn't find {} in the production data.".format(e)) from e
+
+    @timed("parse")
+    def parse_inverters(self, content: bytes) -> int:
+        """
+        Read /production.json.
+        :param content: Raw response body
+        :return: Number of microinverters online
+        """
+        production = _load(content)
+        try:
+            for reading in production["production"]:
+                if reading.get("type") == "inverters":
+                    return int(reading["activeCount"])
+        except (KeyError, TypeError) as e:
+            raise ValueError("Couldn't read the inverter data.") from e
+        raise ValueError("No inverter readings in the production data.")
@@ -0,0 +1,145 @@
+import re
+import logging
+from typing import Callable, Dict, Tuple
+
+from src.metrics import timed
+
+log = logging.getLogger()
+
+
+number_pattern = re.compile(r"([\d.]+)")
+
+# Note: I had to remove tbody from xpath Chrome gave me, and add '/text()' after it.
+current_watts_xpath = "/html/body/div[1]/table/tr[2]/td[2]/text()"
+wh_today_xpath = "/html/body/div[1]/table/tr[3]/td[2]/text()"
+mi_online_xpath = "/html/body/table/tr/td[2]/table/tr[5]/td[2]/text()"
+
+# Compiled once, the first time the full parser is needed. lxml is slow to import and the fast path usually
+# means we never need it, so it isn't imported until then either.
+_compiled = {}  # type: Dict[str, Callable]
+
+# The fast path skips building a tree and looks for the value cell next to its label in the raw page.
+current_watts_pattern = re.compile(rb"<td[^>]*>\s*Currently\s*</td>\s*<td[^>]*>([^<]*)</td>")
+wh_today_pattern = re.compile(rb"<td[^>]*>\s*Today\s*</td>\s*<td[^>]*>([^<]*)</td>")
+mi_online_pattern = re.compile(rb"<td[^>]*>\s*Number of Microinverters Online\s*</td>\s*<td[^>]*>([^<]*)</td>")
+
+
+def _full_parse(content: bytes, *xpaths: str) -> list:
+    """Parse a page into a tree and evaluate each xpath on it."""
+    from lxml import etree, html
+
+    tree = html.fromstring(content)
+    results = []
+    for xpath in xpaths:
+        if xpath not in _compiled:
+            _compiled[xpath] = etree.XPath(xpath)
+        results.append(_compiled[xpath](tree))
+    return results
+
+
+def _first(results: list, name: str) -> str:
+    if not results:
+        raise ValueError("Couldn't find the {} field, the page layout may have changed.".format(name))
+    return results[0]
+
+
+def parse_wh(data: str) -> int:
+    """
+    Convert the text of the "Today" field to watt-hours.
+    """
+    match = number_pattern.findall(data)
+    try:
+        data_float = float(match[0])
+    except ValueError:
+        log.exception("Couldn't convert to float")
+        return 0
+    except IndexError:
+        log.info("Couldn't find a numerical value in the field. Instead, had value of {}".format(data))
+        return 0
+
+    if "kW" in data:
+        data_float *= 1000
+
+    energy_wh = int(data_float)  # Convert it to the base unit, watt hours, to make math easier
+    return energy_wh
+
+
+def parse_watts(data: str) -> float:
+    """
+    Convert the text of the "Currently" field to watts.
+    """
+    match = number_pattern.findall(data)
+    try:
+        data_float = float(match[0])
+    except ValueError:
+        log.exception("Couldn't convert to float")
+        return 0
+    except IndexError:
+        # It seems like wattage is sometimes unavailable and it isn't really clear why
+        log.info("Couldn't find a numerical value in the field. Instead, had value of {}".format(data))
+        return 0
+
+    if "kW" in data:
+        data_float *= 1000  # Convert it to watts
+    return data_float
+
+
+def parse_mi(data: str) -> int:
+    """
+    Convert the text of the microinverters online field to a count.
+    """
+    mi_online = int(data)
+    log.debug("%s out of 24 microinverters online" % mi_online)
+    return mi_online
+
+
+class EnvoyParser:
+    """
+    Pulls values out of the Envoy's /production and /home pages.
+
+    With fast_path on, values are read straight out of the response bytes. If that doesn't find what it expects
+    (say, after a firmware update changes the layout), we fall back to the full html parser.
+    """
+
+    def __init__(self, fast_path: bool = True):
+        self.fast_path = fast_path
+
+    def _production_fields(self, content: bytes) -> Tuple[str, str]:
+        if self.fast_path:
+            current = current_watts_pattern.search(content)
+            today = wh_today_pattern.search(content)
+            if current and today:
+                return today.group(1).decode("utf-8"), current.group(1).decode("utf-8")
+            log.debug("Fast path couldn't read the production page, using the full parser.")
+
+        today, current = _full_parse(content, wh_today_xpath, current_watts_xpath)
+        return _first(today, "today"), _first(current, "currently")
+
+    def _home_field(self, content: bytes) -> str:
+        if self.fast_path:
+            mi_online = mi_online_pattern.search(content)
+            if mi_online:
+                return mi_online.group(1).decode("utf-8")
+            log.debug("Fast path couldn't read the home page, using the full parser.")
+
+        mi_online, = _full_parse(content, mi_online_xpath)
+        return _first(mi_online, "microinverters online")
+
+    @timed("parse")
+    def parse_production(self, content: bytes) -> Tuple[int, float]:
+        """
+        Read the /production page.
+        :param content: Raw page body
+        :return: Energy generated today in watt-hours, and current production in watts
+        """
+        today, current = self._production_fields(content)
+        return parse_wh(today), parse_watts(current)
+
+    @timed("parse")
+    def parse_home(self, content: bytes) -> int:
+        """
+        Read the /home page.
+        :param content: Raw page body
+        :return: Number of microinverters online
+        """
+        return parse_mi(self._home_field(content))
@@ -0,0 +1,182 @@
+import bisect
+import datetime
+import mmap
+import os
+import time
+from typing import Dict, Iterator, List
+
+default_fields = ["timestamp", "wh", "mi_online", "cur_kw_output", "cloud_cover"]
+
+
+def _parse_value(value: bytes) -> float:
+    return float(value) if value else None
+
+
+def parse_time(value: str) -> float:
+    """
+    Turn a command line time into an epoch timestamp. Accepts epoch seconds, an ISO date or datetime (local time),
+    or a duration back from now like 30m, 12h or 7d.
+    """
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    if value[-1:] in units:
+        try:
+            return time.time() - float(value[:-1]) * units[value[-1]]
+        except ValueError:
+            pass
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class HistoryReader:
+    """
+    Reads time ranges out of a csv history file without loading the whole thing.
+
+    The file is memory-mapped, and a sparse index of (timestamp, byte offset) pairs is built by looking at one line
+    every index_stride bytes. A range query looks up where to start in the index and reads forward from there until
+    it passes the end of the range, so memory use stays flat however big the file gets.
+
+    Rows are expected to be in timestamp order, which is how CSVWriter appends them.
+    """
+
+    def __init__(self, csv_path: str, fields: List[str] = None, index_stride: int = 64 * 1024):
+        """
+        :param csv_path: Path to the csv file
+        :param fields: Column names, if the file has no header row
+        :param index_stride: Spacing of the sparse index, in bytes
+        """
+        self.csv_path = csv_path
+        self.fields = fields or default_fields
+        self.index_stride = index_stride
+
+        self._index_timestamps = []
+        self._index_offsets = []
+        self._indexed_size = 0
+
+    @staticmethod
+    def _line_start(mm: mmap.mmap, pos: int) -> int:
+        """Offset of the first line starting at or after pos."""
+        if pos == 0:
+            return 0
+        newline = mm.find(b"\n", pos - 1)
+        return len(mm) if newline == -1 else newline + 1
+
+    @staticmethod
+    def _timestamp_at(mm: mmap.mmap, offset: int) -> float:
+        """Timestamp of the line at offset, or None if it's a header or an unfinished line."""
+        end = mm.find(b"\n", offset)
+        if end == -1:
+            return None
+        comma = mm.find(b",", offset, end)
+        try:
+            return float(mm[offset:comma if comma != -1 else end])
+        except ValueError:
+            return None
+
+    def _update_index(self, mm: mmap.mmap):
+        size = len(mm)
+        if size <= self._indexed_size:
+            return
+
+        if self._indexed_size == 0:
+            # Pick the column names up from the header, if there is one
+            end = mm.find(b"\n")
+            first_line = mm[:end if end != -1 else size]
+            if first_line.startswith(b"timestamp"):
+                self.fields = first_line.decode("utf-8").strip().split(",")
+
+        pos = self._indexed_size
+        last_offset = self._index_offsets[-1] if self._index_offsets else -1
+        while pos < size:
+            offset = self._line_start(mm, pos)
+            timestamp = self._timestamp_at(mm, offset)
+            if timestamp is None and offset < size:
+                # Header row: index the line after it instead
+                offset = self._line_start(mm, offset + 1)
+                timestamp = self._timestamp_at(mm, offset)
+            if timestamp is not None and offset > last_offset:
+                self._index_timestamps.append(timestamp)
+                self._index_offsets.append(offset)
+                last_offset = offset
+            pos += self.index_stride
+
+        # Only count up to the last whole line, so a row that's still being written gets indexed next time
+        self._indexed_size = mm.rfind(b"\n") + 1
+
+    def _start_offset(self, start: float) -> int:
+        if start is None:
+            return 0
+        # Last indexed line before the start of the range
+        i = bisect.bisect_left(self._index_timestamps, start) - 1
+        return self._index_offsets[i] if i >= 0 else 0
+
+    def _raw_rows(self, start: float = None, end: float = None) -> Iterator[List[bytes]]:
+        if not os.path.getsize(self.csv_path):
+            return
+
+        with open(self.csv_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            self._update_index(mm)
+
+            pos = self._start_offset(start)
+            size = len(mm)
+            while pos < size:
+                line_end = mm.find(b"\n", pos)
+                if line_end == -1:
+                    # Unfinished last line
+                    return
+                values = mm[pos:line_end].rstrip(b"\r").split(b",")
+                pos = line_end + 1
+
+                try:
+                    timestamp = float(values[0])
+                except ValueError:
+                    continue
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp >= end:
+                    return
+                yield values
+
+    def rows(self, start: float = None, end: float = None) -> Iterator[Dict[str, float]]:
+        """
+        Yield rows in a time range, oldest first. Empty values come back as None.
+        :param start: Earliest timestamp to include, or None to start at the beginning
+        :param end: Timestamp to stop before, or None to read to the end
+        """
+        for values in self._raw_rows(start, end):
+            yield {name: _parse_value(value) for name, value in zip(self.fields, values)}
+
+    def raw_lines(self, start: float = None, end: float = None) -> Iterator[bytes]:
+        """Yield the lines in a time range as they appear in the file, without the newline."""
+        for values in self._raw_rows(start, end):
+            yield b",".join(values)
+
+    def column_chunks(self, start: float = None, end: float = None,
+                      chunk_rows: int = 8192) -> Iterator[Dict[str, "numpy.ndarray"]]:
+        """
+        Yield a time range as numpy columns, chunk_rows rows at a time. Empty values come back as NaN.
+        """
+        import numpy as np
+
+        # Made once the first row is read, since that's when the header gets picked up
+        columns = None
+
+        def chunk():
+            return {name: np.array(column, dtype=float) for name, column in zip(self.fields, columns)}
+
+        count = 0
+        for values in self._raw_rows(start, end):
+            if columns is None:
+                columns = [[] for _ in self.fields]
+            for i, column in enumerate(columns):
+                value = values[i] if i < len(values) else b""
+                column.append(float(value) if value else np.nan)
+            count += 1
+            if count == chunk_rows:
+                yield chunk()
+                columns = [[] for _ in self.fields]
+                count = 0
+
+        if count:
+            yield chunk()
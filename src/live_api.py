@@ -0,0 +1,88 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlparse
+
+from src.live_store import RecentSamples
+
+log = logging.getLogger()
+
+
+class LiveAPIServer(ThreadingHTTPServer):
+    """
+    Serves recent readings as JSON, straight from memory, so dashboards never cost a gateway request or a sheet read.
+
+        GET /api/sites                    names of the sites we have readings for
+        GET /api/latest?site=<name>       the newest reading
+        GET /api/today?site=<name>        today's readings, oldest first
+        GET /api/summary?site=<name>      today's energy, peak and mean watts, and energy per day
+
+    site can be left out when there's only one.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, stores: Dict[str, RecentSamples], port: int, host: str = ""):
+        """
+        :param stores: Recent readings for each site, by site name
+        :param port: Port to listen on
+        :param host: Address to listen on. Defaults to all of them.
+        """
+        self.stores = stores
+        self._thread = None
+        super(LiveAPIServer, self).__init__((host, port), _LiveAPIHandler)
+
+    def start(self) -> "LiveAPIServer":
+        """Start serving from a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name="live-api", daemon=True)
+        self._thread.start()
+        log.info("Serving the live API on port {}".format(self.server_address[1]))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _LiveAPIHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status: int, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        stores = self.server.stores
+
+        if url.path == "/api/sites":
+            self._send(200, sorted(stores))
+            return
+
+        views = {
+            "/api/latest": RecentSamples.latest,
+            "/api/today": RecentSamples.today,
+            "/api/summary": RecentSamples.summary
+        }
+        view = views.get(url.path)
+        if view is None:
+            self._send(404, {"error": "Unknown endpoint"})
+            return
+
+        site = parse_qs(url.query).get("site", [None])[0]
+        if site is None and len(stores) == 1:
+            site = next(iter(stores))
+        if site not in stores:
+            self._send(404, {"error": "Unknown site, choose one of {}".format(", ".join(sorted(stores)))})
+            return
+
+        self._send(200, view(stores[site]))
+
+    def log_message(self, format, *args):
+        log.debug("Live API: " + format % args)
@@ -0,0 +1,102 @@
+import datetime
+import math
+import threading
+from array import array
+from typing import List
+
+fields = ["timestamp", "wh", "mi_online", "cur_kw_output", "cloud_cover"]
+
+
+def _to_value(value: float):
+    return None if math.isnan(value) else value
+
+
+class RecentSamples:
+    """
+    The most recent rows written, kept in memory for the live API.
+
+    Each field is a flat array of doubles (missing values are NaN) used as a ring, so memory is fixed at capacity
+    rows however long we run. Rows must be added in timestamp order.
+    """
+
+    def __init__(self, capacity: int = 1000):
+        """
+        :param capacity: Most rows to keep. Once full, each new row replaces the oldest.
+        """
+        self.capacity = capacity
+        self._columns = {name: array("d", bytes(8 * capacity)) for name in fields}
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, row_data: dict):
+        """Add a row, as written by the runner."""
+        with self._lock:
+            i = (self._start + self._count) % self.capacity
+            for name, column in self._columns.items():
+                value = row_data.get(name)
+                column[i] = float("nan") if value is None or value == "" else float(value)
+            if self._count < self.capacity:
+                self._count += 1
+            else:
+                self._start = (self._start + 1) % self.capacity
+
+    def _row(self, i: int) -> dict:
+        return {name: _to_value(column[i]) for name, column in self._columns.items()}
+
+    def latest(self) -> dict:
+        """The newest row, or None if we have none."""
+        with self._lock:
+            if not self._count:
+                return None
+            return self._row((self._start + self._count - 1) % self.capacity)
+
+    def since(self, start: float) -> List[dict]:
+        """Rows at or after start, oldest first."""
+        timestamps = self._columns["timestamp"]
+        with self._lock:
+            # Newest first, stopping at the first row that's too old
+            rows = []
+            for n in range(self._count - 1, -1, -1):
+                i = (self._start + n) % self.capacity
+                if timestamps[i] < start:
+                    break
+                rows.append(self._row(i))
+        rows.reverse()
+        return rows
+
+    def today(self) -> List[dict]:
+        """Rows from today (local time), oldest first."""
+        midnight = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        return self.since(midnight.timestamp())
+
+    def summary(self) -> dict:
+        """Simple figures for today, and the energy generated on each day we still hold rows for."""
+        rows = self.today()
+        watts = [row["cur_kw_output"] for row in rows if row["cur_kw_output"] is not None]
+        wh = [row["wh"] for row in rows if row["wh"] is not None]
+
+        # Today's total only goes up until midnight, so the most it got to is the day's energy
+        daily = {}
+        timestamps = self._columns["timestamp"]
+        day_wh = self._columns["wh"]
+        with self._lock:
+            for n in range(self._count):
+                i = (self._start + n) % self.capacity
+                if math.isnan(day_wh[i]):
+                    continue
+                day = datetime.date.fromtimestamp(timestamps[i]).isoformat()
+                daily[day] = max(daily.get(day, 0), day_wh[i])
+
+        return {
+            "samples_today": len(rows),
+            "energy_wh_today": max(wh) if wh else None,
+            "peak_w_today": max(watts) if watts else None,
+            "mean_w_today": sum(watts) / len(watts) if watts else None,
+            "first_today": rows[0]["timestamp"] if rows else None,
+            "last_today": rows[-1]["timestamp"] if rows else None,
+            "daily_energy_wh": daily
+        }
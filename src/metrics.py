@@ -0,0 +1,223 @@
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+log = logging.getLogger()
+
+# Bucket bounds for request and cycle durations, in seconds
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = None) -> str:
+    pairs = ["{}=\"{}\"".format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, description: str, label_names: List[str] = None):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names or ())
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError("{} takes the labels {}, got {}".format(self.name, self.label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            return [("", _format_labels(self.label_names, key), value) for key, value in sorted(self._values.items())]
+
+    def render(self) -> List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        for suffix, labels, value in self._samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, labels, _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: List[str] = None,
+                 buckets: Tuple[float, ...] = default_buckets):
+        super(Histogram, self).__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = "le=\"{}\"".format(_format_value(bound))
+                    samples.append(("_bucket", _format_labels(self.label_names, key, le), count))
+                samples.append(("_sum", _format_labels(self.label_names, key), total))
+                samples.append(("_count", _format_labels(self.label_names, key), counts[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    A set of metrics that can be rendered in the Prometheus text format.
+
+    They can be written to a file for node_exporter's textfile collector (export_path), served over http, or both.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # type: Dict[str, _Metric]
+        self._export_lock = threading.Lock()
+        self.export_path = None
+        self._server = None
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError("A metric called {} already exists.".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, label_names: List[str] = None) -> Counter:
+        return self._register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, label_names: List[str] = None) -> Gauge:
+        return self._register(Gauge(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names: List[str] = None,
+                  buckets: Tuple[float, ...] = default_buckets) -> Histogram:
+        return self._register(Histogram(name, description, label_names, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """Write our metrics to export_path, if one is set. The file is replaced whole, so it's never seen half done."""
+        if self.export_path is None:
+            return
+        with self._export_lock:
+            tmp_path = self.export_path + ".tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    f.write(self.render())
+                os.replace(tmp_path, self.export_path)
+            except OSError:
+                log.exception("Couldn't write metrics to {}".format(self.export_path))
+
+    def serve(self, port: int, host: str = ""):
+        """Serve our metrics at http://host:port/metrics from a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        log.info("Serving metrics on port {}".format(self._server.server_address[1]))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+registry = MetricsRegistry()
+
+stage_duration = registry.histogram("pysolar_stage_duration_seconds",
+                                    "Time spent in each stage of a polling cycle.", ["stage"])
+stage_errors = registry.counter("pysolar_stage_errors_total", "Stage calls that raised an error.", ["stage"])
+cycle_duration = registry.histogram("pysolar_cycle_duration_seconds", "Time taken by a whole polling cycle.",
+                                    ["site"])
+rows_written = registry.counter("pysolar_rows_written_total", "Rows written out.", ["site"])
+last_sample_time = registry.gauge("pysolar_last_sample_timestamp_seconds",
+                                  "When the last new reading was taken, as a unix timestamp.", ["site"])
+sample_age = registry.gauge("pysolar_sample_age_seconds",
+                            "Age of the last reading written when it was written.", ["site"])
+weather_age = registry.gauge("pysolar_weather_age_seconds", "Age of the cloud cover reading used last.")
+
+
+@contextmanager
+def time_stage(stage: str):
+    """Record how long the block takes under stage, and count it as an error if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed(stage: str):
+    """Decorator form of time_stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
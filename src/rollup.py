@@ -0,0 +1,272 @@
+import csv
+import json
+import logging
+import os
+import time
+from typing import List
+
+import numpy as np
+
+log = logging.getLogger()
+
+
+periods = ("hour", "day", "month")
+_period_units = {"hour": "datetime64[h]", "day": "datetime64[D]", "month": "datetime64[M]"}
+
+# Running totals kept for every bucket. Everything is a plain sum apart from peak_w, which is a max, so buckets can
+# be topped up with new samples without going back over the old ones.
+_stat_names = ["samples", "energy_wh", "peak_w", "watts_sum", "watts_samples", "online_samples", "mi_sum",
+               "cloud_samples", "cloud_sum", "cloud_watts_sum", "cw_sum", "cc_sum", "ww_sum"]
+_stat = {name: i for i, name in enumerate(_stat_names)}
+
+default_fields = ["timestamp", "wh", "mi_online", "cur_kw_output", "cloud_cover"]
+
+
+def _local_timestamps(timestamps: np.ndarray) -> np.ndarray:
+    """Shift epoch timestamps into local time, respecting daylight saving."""
+    # The utc offset only changes on the hour, so look it up once per distinct hour rather than per sample.
+    hours, inverse = np.unique(timestamps // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(hour * 3600).tm_gmtoff for hour in hours], dtype=float)
+    return timestamps + offsets[inverse]
+
+
+class RollupEngine:
+    """
+    Hourly, daily and monthly summaries of the sampled history.
+
+    For each bucket we track the energy generated (from the differences in the cumulative "wh" column, which
+    resets every night), peak and mean watts, microinverter uptime and how cloud cover correlates with
+    production. New samples can be added at any time, whether from the live loop or from the csv history.
+    """
+
+    def __init__(self, state_path: str = None):
+        """
+        :param state_path: Optional file to save our running totals to, so a restart picks up where we left off.
+        """
+        self.state_path = state_path
+
+        self._buckets = {period: {} for period in periods}
+        # Last valid (timestamp, wh, local day) seen, so energy can be worked out across batches
+        self._last = None
+        # How far into each csv file we've read
+        self._csv_offsets = {}
+
+        if state_path is not None and os.path.exists(state_path):
+            self._load()
+
+    def _load(self):
+        with open(self.state_path, "r") as f:
+            state = json.load(f)
+        self._buckets = {period: {key: np.array(stats) for key, stats in state["buckets"][period].items()}
+                         for period in periods}
+        self._last = tuple(state["last"]) if state["last"] is not None else None
+        self._csv_offsets = state["csv_offsets"]
+
+    def save(self):
+        """Save our running totals to state_path."""
+        if self.state_path is None:
+            return
+        state = {
+            "buckets": {period: {key: stats.tolist() for key, stats in buckets.items()}
+                        for period, buckets in self._buckets.items()},
+            "last": self._last,
+            "csv_offsets": self._csv_offsets
+        }
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _interval_energy(self, timestamps: np.ndarray, wh: np.ndarray, days: np.ndarray) -> np.ndarray:
+        """Energy generated since the previous sample, in watt-hours."""
+        energy = np.zeros(len(wh))
+        valid = np.flatnonzero(~np.isnan(wh))
+        if not len(valid):
+            return energy
+
+        cur_wh = wh[valid]
+        cur_days = days[valid]
+        if self._last is not None:
+            prev_wh = np.concatenate(([self._last[1]], cur_wh[:-1]))
+            prev_days = np.concatenate(([self._last[2]], cur_days[:-1]))
+        else:
+            # With nothing before it, the first sample gets everything generated since midnight
+            prev_wh = np.concatenate(([0], cur_wh[:-1]))
+            prev_days = cur_days.copy()
+
+        diff = cur_wh - prev_wh
+        # A new day starts the counter over, and a drop within a day is a glitch we don't count.
+        energy[valid] = np.where(cur_days != prev_days, cur_wh, np.maximum(diff, 0))
+
+        self._last = (float(timestamps[valid[-1]]), float(cur_wh[-1]), int(cur_days[-1]))
+        return energy
+
+    def add_samples(self, timestamps, wh, mi_online, watts, cloud_cover):
+        """
+        Add a batch of samples, oldest first. Missing values should be NaN.
+        """
+        timestamps = np.asarray(timestamps, dtype=float)
+        if not len(timestamps):
+            return
+        wh = np.asarray(wh, dtype=float)
+        mi_online = np.asarray(mi_online, dtype=float)
+        watts = np.asarray(watts, dtype=float)
+        cloud_cover = np.asarray(cloud_cover, dtype=float)
+
+        local = _local_timestamps(timestamps).astype("datetime64[s]")
+        days = local.astype("datetime64[D]").astype(np.int64)
+        energy = self._interval_energy(timestamps, wh, days)
+
+        watts_ok = ~np.isnan(watts)
+        mi_ok = ~np.isnan(mi_online)
+        # Weather errors are recorded as -1
+        cloud_ok = watts_ok & (cloud_cover >= 0) & (cloud_cover <= 1)
+
+        w = np.where(watts_ok, watts, 0)
+        c = np.where(cloud_ok, cloud_cover, 0)
+        # Watts again, but only for samples that have cloud data, for the correlation
+        cw = np.where(cloud_ok, w, 0)
+
+        per_sample = np.zeros((len(timestamps), len(_stat_names)))
+        per_sample[:, _stat["samples"]] = 1
+        per_sample[:, _stat["energy_wh"]] = energy
+        per_sample[:, _stat["watts_sum"]] = w
+        per_sample[:, _stat["watts_samples"]] = watts_ok
+        per_sample[:, _stat["online_samples"]] = mi_ok & (np.where(mi_ok, mi_online, 0) > 0)
+        per_sample[:, _stat["mi_sum"]] = np.where(mi_ok, mi_online, 0)
+        per_sample[:, _stat["cloud_samples"]] = cloud_ok
+        per_sample[:, _stat["cloud_sum"]] = c
+        per_sample[:, _stat["cloud_watts_sum"]] = cw
+        per_sample[:, _stat["cw_sum"]] = c * cw
+        per_sample[:, _stat["cc_sum"]] = c * c
+        per_sample[:, _stat["ww_sum"]] = cw * cw
+
+        for period in periods:
+            keys = local.astype(_period_units[period])
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+            sums = np.zeros((len(unique_keys), len(_stat_names)))
+            np.add.at(sums, inverse, per_sample)
+
+            peaks = np.full(len(unique_keys), -np.inf)
+            np.maximum.at(peaks, inverse, np.where(watts_ok, watts, -np.inf))
+            sums[:, _stat["peak_w"]] = peaks
+
+            buckets = self._buckets[period]
+            for key, stats in zip(unique_keys, sums):
+                key = str(key)
+                existing = buckets.get(key)
+                if existing is not None:
+                    peak = max(existing[_stat["peak_w"]], stats[_stat["peak_w"]])
+                    stats = existing + stats
+                    stats[_stat["peak_w"]] = peak
+                buckets[key] = stats
+
+    def add_row(self, row_data: dict):
+        """
+        Add a single row, as written by the runner.
+        """
+        def value(name):
+            v = row_data.get(name)
+            return np.nan if v is None or v == "" else float(v)
+
+        self.add_samples([value("timestamp")], [value("wh")], [value("mi_online")], [value("cur_kw_output")],
+                         [value("cloud_cover")])
+
+    def update_from_csv(self, csv_path: str) -> int:
+        """
+        Add any rows that have been appended to a csv history file since we last read it.
+        :return: Number of rows added
+        """
+        key = os.path.abspath(csv_path)
+        offset = self._csv_offsets.get(key, 0)
+        size = os.path.getsize(csv_path)
+        if size < offset:
+            # Rewritten or replaced since we last read it, so read it again from the start
+            log.warning("{} is smaller than when we last read it, reading it from the start.".format(csv_path))
+            offset = 0
+
+        with open(csv_path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+
+        # Leave any half-written last line for next time
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].decode("utf-8").splitlines()
+        self._csv_offsets[key] = offset + end
+
+        fields = default_fields
+        rows = []
+        for row in csv.reader(lines):
+            if not row:
+                continue
+            if row[0] == "timestamp":
+                fields = row
+                continue
+            rows.append(row)
+        if not rows:
+            return 0
+
+        columns = {name: i for i, name in enumerate(fields)}
+        table = np.full((len(rows), len(fields)), np.nan)
+        for i, row in enumerate(rows):
+            for j, v in enumerate(row[:len(fields)]):
+                if v:
+                    table[i, j] = float(v)
+
+        order = np.argsort(table[:, columns["timestamp"]], kind="stable")
+        table = table[order]
+        self.add_samples(table[:, columns["timestamp"]], table[:, columns["wh"]], table[:, columns["mi_online"]],
+                         table[:, columns["cur_kw_output"]], table[:, columns["cloud_cover"]])
+        return len(rows)
+
+    def table(self, period: str) -> List[dict]:
+        """
+        Get the summary for every bucket of a period, oldest first.
+        :param period: One of "hour", "day" or "month"
+        """
+        rows = []
+        for key in sorted(self._buckets[period]):
+            stats = self._buckets[period][key]
+            samples = stats[_stat["samples"]]
+            watts_samples = stats[_stat["watts_samples"]]
+            rows.append({
+                "period": key,
+                "samples": int(samples),
+                "energy_wh": float(stats[_stat["energy_wh"]]),
+                "peak_w": float(stats[_stat["peak_w"]]) if watts_samples else None,
+                "mean_w": float(stats[_stat["watts_sum"]] / watts_samples) if watts_samples else None,
+                "mi_online_mean": float(stats[_stat["mi_sum"]] / samples),
+                "uptime": float(stats[_stat["online_samples"]] / samples),
+                "cloud_correlation": self._correlation(stats)
+            })
+        return rows
+
+    @staticmethod
+    def _correlation(stats: np.ndarray) -> float:
+        """Pearson correlation between cloud cover and watts, or None if there isn't enough to go on."""
+        n = stats[_stat["cloud_samples"]]
+        if n < 3:
+            return None
+        sum_c = stats[_stat["cloud_sum"]]
+        sum_w = stats[_stat["cloud_watts_sum"]]
+        cov = stats[_stat["cw_sum"]] - sum_c * sum_w / n
+        var_c = stats[_stat["cc_sum"]] - sum_c * sum_c / n
+        var_w = stats[_stat["ww_sum"]] - sum_w * sum_w / n
+        if var_c <= 0 or var_w <= 0:
+            return None
+        return float(cov / np.sqrt(var_c * var_w))
+
+    def write_tables(self, out_dir: str):
+        """Write each period's summary to <out_dir>/<period>.csv."""
+        os.makedirs(out_dir, exist_ok=True)
+        for period in periods:
+            rows = self.table(period)
+            path = os.path.join(out_dir, "{}.csv".format(period))
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", newline="") as f:
+                writer = csv.DictWriter(f, ["period", "samples", "energy_wh", "peak_w", "mean_w", "mi_online_mean",
+                                            "uptime", "cloud_correlation"])
+                writer.writeheader()
+                writer.writerows(rows)
+            os.replace(tmp_path, path)
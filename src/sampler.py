@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from array import array
+from typing import Callable, NamedTuple
+
+log = logging.getLogger()
+
+
+class IntervalStats(NamedTuple):
+    """Summary of the samples taken over one reporting interval."""
+    samples: int
+    watts_min: float
+    watts_max: float
+    watts_mean: float
+    # Energy generated over the interval, from integrating the samples
+    energy_wh: float
+
+
+class WattRing:
+    """
+    A fixed-size ring of (timestamp, watts) samples, kept in two flat arrays of doubles rather than as objects.
+    Once full, each new sample replaces the oldest.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._timestamps = array("d", bytes(8 * capacity))
+        self._watts = array("d", bytes(8 * capacity))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp: float, watts: float):
+        i = (self._start + self._count) % self.capacity
+        self._timestamps[i] = timestamp
+        self._watts[i] = watts
+        if self._count < self.capacity:
+            self._count += 1
+        else:
+            self._start = (self._start + 1) % self.capacity
+
+    def clear(self):
+        self._start = 0
+        self._count = 0
+
+    def samples(self):
+        """Yield (timestamp, watts) pairs, oldest first."""
+        for n in range(self._count):
+            i = (self._start + n) % self.capacity
+            yield self._timestamps[i], self._watts[i]
+
+
+class WattSampler:
+    """
+    Samples current production much more often than full readings are taken, and boils the samples down to one
+    summary per reporting interval.
+
+    A background thread reads the watts every interval seconds into a WattRing, so memory use is fixed however
+    long a reporting interval runs. take() summarises everything since the last call and starts a new interval.
+    """
+
+    def __init__(self, read_watts: Callable[[], float], interval: float = 15, capacity: int = 256,
+                 max_gap: float = None):
+        """
+        :param read_watts: Function returning the current production in watts
+        :param interval: Time between samples, in seconds
+        :param capacity: Most samples to hold. Once full, the oldest are dropped.
+        :param max_gap: Longest gap between samples to integrate energy across, in seconds. Defaults to 4 intervals.
+        """
+        self.read_watts = read_watts
+        self.interval = interval
+        self.max_gap = max_gap if max_gap is not None else 4 * interval
+
+        self._ring = WattRing(capacity)
+        self._lock = threading.Lock()
+        # Last sample of the previous interval, so energy is counted across the boundary between intervals
+        self._carry = None
+
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """Take one sample now."""
+        try:
+            watts = self.read_watts()
+        except Exception:
+            log.warning("Couldn't sample current production.", exc_info=True)
+            return
+        if watts is None:
+            return
+        with self._lock:
+            self._ring.append(time.time(), watts)
+
+    def _run(self):
+        # Sample against absolute deadlines, so slow reads don't make the samples drift apart
+        deadline = time.monotonic()
+        while not self._stopping.is_set():
+            self.sample()
+            deadline += self.interval
+            now = time.monotonic()
+            if deadline < now:
+                # We fell behind (a slow gateway), skip the samples we missed rather than rushing to catch up
+                deadline = now + self.interval
+            self._stopping.wait(deadline - now)
+
+    def take(self) -> IntervalStats:
+        """
+        Summarise the samples taken since the last call, and start a new interval.
+        :return: The summary, or None if no samples were taken
+        """
+        with self._lock:
+            samples = list(self._ring.samples())
+            self._ring.clear()
+            carry = self._carry
+            if samples:
+                self._carry = samples[-1]
+
+        if not samples:
+            return None
+
+        watts_min = watts_max = samples[0][1]
+        watts_sum = 0
+        energy_ws = 0
+        previous = carry
+        for timestamp, watts in samples:
+            if watts < watts_min:
+                watts_min = watts
+            elif watts > watts_max:
+                watts_max = watts
+            watts_sum += watts
+            if previous is not None and 0 < timestamp - previous[0] <= self.max_gap:
+                # Trapezoidal rule
+                energy_ws += (timestamp - previous[0]) * (watts + previous[1]) / 2
+            previous = (timestamp, watts)
+
+        return IntervalStats(len(samples), watts_min, watts_max, watts_sum / len(samples), energy_ws / 3600)
+
+    def start(self):
+        """Start sampling in the background."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="watt-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        """Stop sampling."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,224 @@
+import logging
+import math
+import time
+from collections import deque
+
+log = logging.getLogger()
+
+
+class PollScheduler:
+    """
+    Works out when to next poll the gateway.
+
+    The gateway only updates its numbers every so often (about 10 minutes), so polling on a fixed timer means a
+    reading can be up to a whole period old by the time we see it. Instead we keep an estimate of when the gateway
+    last refreshed and aim each poll just after the next one. A poll that finds nothing new narrows down where the
+    refresh really happens; a long run of them (overnight, or during an outage) backs the polling off.
+
+    The period itself is measured from the spacing of the polls that found something new, so a gateway that
+    refreshes faster or slower than the starting guess is still caught on every refresh.
+
+    All times come from the monotonic clock, and waits are made to absolute deadlines, so the schedule doesn't
+    drift by however long each cycle took.
+    """
+
+    def __init__(self, period: float = 600, margin: float = 15, min_interval: float = 30,
+                 max_interval: float = 1800, backoff: float = 2, outage_periods: float = 3,
+                 recheck_every: int = 8):
+        """
+        :param period: Starting guess for how often the gateway refreshes, in seconds
+        :param margin: How long after the expected refresh to poll
+        :param min_interval: Shortest time between polls
+        :param max_interval: Longest time between polls
+        :param backoff: Growth factor for the wait after each poll that finds nothing new
+        :param outage_periods: How many periods without anything new before we back off past the period
+        :param recheck_every: Once we know when the gateway refreshes, how many refreshes to catch before checking
+        again that we still do. Each check that passes doubles this, up to 8 times over.
+        """
+        self.period = period
+        self.margin = margin
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.outage_periods = outage_periods
+        self.recheck_every = recheck_every
+
+        self._last_poll = None
+        self._last_change = None
+        # Earliest and latest time the gateway's last refresh could have happened
+        self._window = None
+        self._unchanged_streak = 0
+        # Whether the last two polls both found something new
+        self._back_to_back = False
+        self._deadline = None
+
+        # (previous poll, poll) around each refresh we saw, for measuring the period
+        self._changes = deque(maxlen=8)
+        # The same for the refreshes we managed to pin down closely, for measuring the period precisely
+        self._narrow_changes = deque(maxlen=8)
+        # Shortest and longest the period could be, going by those
+        self._period_bounds = (0, math.inf)
+        # Once the window is narrow, one poll goes just before the expected refresh. Finding nothing new there, and
+        # something new just after, confirms the schedule and measures the period precisely. Finding something new
+        # there means the gateway is faster than we think and we've only been seeing some of its refreshes.
+        self._confirming = False
+        # Whether the last check found something new early as well
+        self._early_before = False
+        # Refreshes caught on a confirmed schedule since it was last checked, or None if it isn't confirmed
+        self._locked = None
+        # Small errors in the period add up, so the schedule is checked again after this many
+        self._recheck_after = recheck_every
+
+    def record(self, changed: bool, now: float = None):
+        """
+        Note the result of a poll.
+        :param changed: Whether the gateway had new values
+        :param now: Monotonic time of the poll. Defaults to now.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        confirming, self._confirming = self._confirming, False
+        if changed:
+            if confirming:
+                # A refresh came before the one we expected. Once could be the schedule drifting, but twice running
+                # means we've been missing some.
+                if self._early_before:
+                    self.period = max(self.min_interval, self.period / 2)
+                    log.info("Gateway refreshes more often than we thought, trying a period of {:.0f}s."
+                             .format(self.period))
+                    self._changes.clear()
+                    self._narrow_changes.clear()
+                    self._period_bounds = (0, math.inf)
+                self._early_before = not self._early_before
+                self._window = None
+                self._locked = None
+                self._recheck_after = self.recheck_every
+
+            lower = self._last_poll if self._last_poll is not None else now - self.period
+            if self._last_poll is not None:
+                self._changes.append((lower, now))
+                if now - lower <= 4 * self.margin:
+                    self._narrow_changes.append((lower, now))
+                self._update_period()
+
+            # The refresh happened somewhere between our last poll and this one. If we already had a rough idea
+            # of when it would be, and of the period, that narrows it down further.
+            lo, hi = lower, now
+            if self._window is not None and now - lower > 2 * self.margin:
+                # Once the schedule's confirmed the period is known well enough to use as it is
+                period_low, period_high = self._period_bounds if self._locked is None else (self.period, self.period)
+                lo = max(self._window[0] + period_low, lower)
+                hi = min(self._window[1] + period_high, now)
+                if lo > hi:
+                    # The gateway's schedule moved, start over
+                    lo, hi = lower, now
+                    self._locked = None
+
+            self._window = (lo, hi)
+            if not self._is_tight():
+                self._locked = None
+                self._recheck_after = self.recheck_every
+            elif self._locked is not None:
+                self._locked += 1
+            self._back_to_back = self._last_poll is not None and self._unchanged_streak == 0
+            self._unchanged_streak = 0
+            self._last_change = now
+        else:
+            if confirming:
+                if self._locked is not None:
+                    # A recheck that passed, so the next can wait longer
+                    self._recheck_after = min(2 * self._recheck_after, 8 * self.recheck_every)
+                self._locked = 0
+                self._early_before = False
+            self._unchanged_streak += 1
+
+        self._last_poll = now
+        self._deadline = now + self._next_delay(now)
+
+    def _is_tight(self) -> bool:
+        return self._window is not None and self._window[1] - self._window[0] <= 2 * self.margin
+
+    def _update_period(self):
+        # Each pair of neighbouring refreshes we saw bounds the period. Nothing new turned up between the earlier
+        # one and the poll before the later one, so the period is at least that long. Every window held at least
+        # one refresh, so however many windows there are, one fewer periods fit between the start of the first and
+        # the end of the last. Narrow the bounds down together, newest first, stopping at any that disagree with
+        # the rest: the gateway's schedule has changed since.
+        changes = list(self._changes)
+        low, high = 0, math.inf
+        for i in range(len(changes) - 2, -1, -1):
+            pair_low = changes[i + 1][0] - changes[i][1]
+            span_high = (changes[-1][1] - changes[i][0]) / (len(changes) - 1 - i)
+            if pair_low > high or span_high < low:
+                break
+            low, high = max(low, pair_low), min(high, span_high)
+
+        # The bounds are rough unless the polls around each refresh were close together, but they're enough to
+        # tell that a starting guess is far off
+        period = min(max(self.period, low), high)
+
+        # Refreshes we pinned down closely measure it precisely: the time between two of them over the number of
+        # periods in between, which allows for any refreshes we missed. The further apart, the better.
+        narrow = list(self._narrow_changes)
+        if len(narrow) >= 2:
+            newest_lo, newest_hi = narrow[-1]
+            fine_low, fine_high = low, high
+            measured = False
+            for earlier_lo, earlier_hi in reversed(narrow[:-1]):
+                periods = max(1, round((newest_lo + newest_hi - earlier_lo - earlier_hi) / 2 / period))
+                pair_low, pair_high = (newest_lo - earlier_hi) / periods, (newest_hi - earlier_lo) / periods
+                if pair_low > fine_high or pair_high < fine_low:
+                    break
+                fine_low, fine_high = max(fine_low, pair_low), min(fine_high, pair_high)
+                measured = True
+            if measured:
+                low, high = fine_low, fine_high
+                period = (low + high) / 2
+
+        if not self.min_interval <= period <= self.max_interval:
+            return
+        self._period_bounds = (low, high)
+        if abs(period - self.period) > 1:
+            log.info("Gateway appears to refresh every {:.0f}s.".format(period))
+        self.period = period
+
+    def _next_delay(self, now: float) -> float:
+        if self._window is None:
+            delay = self.period
+        elif self._unchanged_streak == 0:
+            lo, hi = self._window
+            if self._is_tight() and (self._locked is None or self._locked >= self._recheck_after):
+                # Check that nothing's new just before the next refresh should happen
+                target = lo + self.period - self.margin
+                self._confirming = True
+            elif self._is_tight():
+                # We know when the gateway refreshes, so poll just after the next one.
+                target = hi + self.period + self.margin
+            elif self._back_to_back:
+                # Every poll is finding something new, so we can't tell where in between the refreshes happen, or
+                # whether there's more than one. Aim for the earliest the next could be and let the retries find it.
+                target = lo + self.period
+            else:
+                # Not sure yet: aim for the middle of where it could be. Either we catch the refresh, which moves
+                # the window's end in, or we're early and the quick retry that follows pins it down.
+                target = (lo + hi) / 2 + self.period
+            delay = target - now
+        else:
+            # We're early, or the gateway has nothing new to say. Check back soon, then less and less often.
+            delay = self.min_interval * self.backoff ** (self._unchanged_streak - 1)
+            if self._last_change is not None and now - self._last_change < self.outage_periods * self.period:
+                # A refresh is still due, so don't wait so long that we can't tell when it happened
+                delay = min(delay, self.period / 2)
+
+        return min(max(delay, self.min_interval), self.max_interval)
+
+    def seconds_until_next(self) -> float:
+        """Time left until the next poll is due."""
+        if self._deadline is None:
+            return 0
+        return max(0, self._deadline - time.monotonic())
+
+    def wait(self):
+        """Sleep until the next poll is due."""
+        time.sleep(self.seconds_until_next())
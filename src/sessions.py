@@ -0,0 +1,18 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def make_session(pool_connections: int = 1, pool_maxsize: int = 4) -> requests.Session:
+    """
+    Build a session that keeps connections alive between requests.
+
+    Sessions don't have a default timeout, so callers should still pass one on every request.
+
+    :param pool_connections: Number of hosts to keep connection pools for
+    :param pool_maxsize: Number of connections to keep open to each host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
@@ -1,19 +1,83 @@
+import copy
 import datetime
 import json
 import logging
-import gspread
-from requests import get
-from oauth2client.service_account import ServiceAccountCredentials
+import threading
+from typing import List, Tuple
+
+from src.metrics import timed
+from src.token_manager import TokenManager
 
 ts_format = "%m/%d/%Y %H:%M:%S"
 
 log = logging.getLogger()
 
 
+def column_index(col: str) -> int:
+    """Turn a column letter (A, B, ..., AA) into its 1-based index."""
+    index = 0
+    for letter in col.upper():
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index
+
+
+def column_letter(index: int) -> str:
+    """Turn a 1-based column index into its letter."""
+    letters = ""
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+class _SheetConnection:
+    """
+    The authorized client and open spreadsheet, shared between a reader and its views of other tabs. Once open,
+    the access token is kept fresh in the background by a TokenManager.
+
+    Nothing touches the network until open() is first called. gspread and oauth2client are slow to import, so they
+    aren't imported until then either.
+    """
+
+    def __init__(self, creds_path: str, sheet_url: str, scope: List[str]):
+        self.creds_path = creds_path
+        self.sheet_url = sheet_url
+        self.scope = scope
+
+        self.lock = threading.RLock()
+        self.credentials = None
+        self.client = None
+        self.spreadsheet = None
+        self.tokens = None
+
+    def open(self) -> "_SheetConnection":
+        with self.lock:
+            if self.spreadsheet is None:
+                import gspread
+                from oauth2client.service_account import ServiceAccountCredentials
+
+                log.info("Connecting to the sheet...")
+                credentials = ServiceAccountCredentials.from_json_keyfile_name(self.creds_path, self.scope)
+                # credentials = SignedJwtAssertionCredentials(json_key['client_email'], json_key['private_key'], scope)
+                client = gspread.authorize(credentials)
+                self.spreadsheet = client.open_by_url(self.sheet_url)
+                self.credentials, self.client = credentials, client
+                self.tokens = TokenManager(credentials, client)
+                self.tokens.start()
+        return self
+
+    def close(self):
+        with self.lock:
+            if self.tokens is not None:
+                self.tokens.stop()
+
+
 class SheetReader:
     """
     Reads and writes the google sheet that we'll be using.
     Requires a config.json file to be in the running directory.
+
+    The sheet isn't connected to until it's first used (or connect() is called), so creating a reader is cheap.
     """
 
     def __init__(self, config_path: str = "config.json"):
@@ -28,41 +92,104 @@ class SheetReader:
         creds_path = config_json["service_account_json"]
         sheet_url = config_json["chart_url"]
 
-        self._credentials = ServiceAccountCredentials.from_json_keyfile_name(creds_path, self.scope)
-        # credentials = SignedJwtAssertionCredentials(json_key['client_email'], json_key['private_key'], scope)
-        self._gc = gspread.authorize(self._credentials)
-        self._sh = self._gc.open_by_url(sheet_url)
-        self._worksheet = self._sh.get_worksheet(0)
+        self._connection = _SheetConnection(creds_path, sheet_url, self.scope)
+        # Title of our tab, or None for the first one. Looked up on first use.
+        self._worksheet_title = None
+        self._worksheet = None
 
         self.ts_col = "A"
+        self.pos_cell = "F1"
+
+        # Local copy of the row pointer stored in F1. It's read from the sheet once and then only written back.
+        self._cur_pos = None
 
         self.ext_ip_cell = "K2"
         self.int_ip_cell = "L2"
 
+    def connect(self) -> "SheetReader":
+        """
+        Connect to the sheet and look up our tab, if that hasn't happened yet. The tab is created if it doesn't
+        exist.
+        """
+        if self._worksheet is not None:
+            return self
+
+        import gspread
+
+        connection = self._connection.open()
+        with connection.lock:
+            if self._worksheet is not None:
+                return self
+            if self._worksheet_title is None:
+                self._worksheet = connection.spreadsheet.get_worksheet(0)
+                return self
+            try:
+                self._worksheet = connection.spreadsheet.worksheet(self._worksheet_title)
+            except gspread.WorksheetNotFound:
+                log.info("Creating worksheet {}".format(self._worksheet_title))
+                self._worksheet = connection.spreadsheet.add_worksheet(self._worksheet_title, rows=1000, cols=12)
+                self.cur_pos = 1
+        return self
+
+    def for_worksheet(self, title: str) -> "SheetReader":
+        """
+        Get a reader for another tab of the same spreadsheet. It shares our client and credentials, but keeps its
+        own row pointer. The tab is looked up (and created if it doesn't exist yet) on first use.
+        :param title: Title of the tab
+        """
+        view = copy.copy(self)
+        view._cur_pos = None
+        view._worksheet_title = title
+        view._worksheet = None
+        return view
+
+    def close(self):
+        """Stop refreshing the access token. Shared with any views of other tabs."""
+        self._connection.close()
+
+    def _ensure_token(self):
+        """
+        Make sure the access token is valid before a write. The background refresh normally keeps it that way, so
+        this is only a local check, and a failed refresh stops the write before any of it is sent.
+        """
+        self._connection.open().tokens.ensure_fresh()
+
     @property
-    def gc(self) -> gspread.Client:
-        if self._credentials.access_token_expired:
-            self._gc.login()
-        return self._gc
+    def gc(self) -> "gspread.Client":
+        return self._connection.open().client
 
     @property
-    def worksheet(self) -> gspread.Worksheet:
-        """Use a property to make sure that we refresh our access token if needed"""
-        if self._credentials.access_token_expired:
-            self._gc.login()
+    def _sh(self) -> "gspread.Spreadsheet":
+        return self._connection.open().spreadsheet
+
+    @property
+    def worksheet(self) -> "gspread.Worksheet":
+        """Our tab, connecting to the sheet first if needed."""
+        self.connect()
         return self._worksheet
 
     @property
-    def cur_pos(self):
+    def cur_pos(self) -> int:
         """
-        Represents the row that we have last edited. Stored on the sheet as a cell.
+        Represents the row that we have last edited. Stored on the sheet as a cell, and cached locally after the
+        first read.
         """
         # TODO Add a routine to create this whole document, including setting a base for this value
-        return self.worksheet.acell('F1').value
+        if self._cur_pos is None:
+            self._ensure_token()
+            self._cur_pos = int(self.worksheet.acell(self.pos_cell).value)
+        return self._cur_pos
 
     @cur_pos.setter
     def cur_pos(self, value):
-        self.worksheet.update_acell("F1", value)
+        self._ensure_token()
+        self.worksheet.update_acell(self.pos_cell, value)
+        self._cur_pos = int(value)
+
+    def _sheet_range(self, rowcol: str) -> str:
+        """Qualify a rowcol value with our worksheet's title so it can be used in a batch update."""
+        # A quote inside a quoted sheet name is written twice, like 'Bob''s'!A1
+        return "'{}'!{}".format(self.worksheet.title.replace("'", "''"), rowcol)
 
     def write_cell(self, rowcol: str, value):
         """
@@ -70,9 +197,24 @@ class SheetReader:
         :param rowcol: Rowcol value, like A5 or BA3
         :param value: Value to write
         """
+        self._ensure_token()
         self.worksheet.update_acell(rowcol, value)
 
-    def update_row(self, data: dict, ts_col="A"):
+    def write_cells(self, cells: dict):
+        """
+        Write several cells in a single request.
+        :param cells: Dict of rowcol value to the value to write there
+        """
+        if not cells:
+            return
+
+        self._ensure_token()
+        self._sh.values_batch_update({
+            "valueInputOption": "USER_ENTERED",
+            "data": [{"range": self._sheet_range(rowcol), "values": [[value]]} for rowcol, value in cells.items()]
+        })
+
+    def update_row(self, data: dict, ts_col="A", extra_cells: dict = None, timestamp: datetime.datetime = None):
         """
         Update a full row of data.
         Extra data can be added through kwargs like
@@ -86,21 +228,79 @@ class SheetReader:
 
         Do not fill in A, as that will be used for a timestamp.
 
+        The row, the position counter and any extra cells are all sent in one batch request.
+
+        :param data: Dict of column to value
+        :param ts_col: Column the timestamp is written to
+        :param extra_cells: Other cells (like "K2") to write alongside the row
+        :param timestamp: Time to record for the row. Defaults to now.
         """
 
         if ts_col in data.keys():
             raise ValueError("Reserved value for timestamp must not be in data.")
 
-        # TODO Update this so that we can pass in a dictionary (or kwargs) with a column and data
-        timestamp_dt = datetime.datetime.now()
-        timestamp_str = timestamp_dt.strftime(ts_format)
-        # Increment the current position by 1
-        cur_pos = int(self.cur_pos)
-        self.cur_pos = str(cur_pos + 1)
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+
+        self.update_rows([(timestamp, data)], ts_col, extra_cells)
+
+    @timed("sheet")
+    def update_rows(self, rows: List[Tuple[datetime.datetime, dict]], ts_col="A", extra_cells: dict = None):
+        """
+        Append several rows in a single batch request.
+        :param rows: List of (timestamp, data) pairs, in the order they should appear on the sheet
+        :param ts_col: Column the timestamp is written to
+        :param extra_cells: Other cells to write alongside the rows
+        """
+        if not rows:
+            return
+
+        pos = self.cur_pos
+        cells = {}
+        for timestamp, data in rows:
+            if ts_col in data.keys():
+                raise ValueError("Reserved value for timestamp must not be in data.")
+
+            pos += 1
+            cells[ts_col + str(pos)] = timestamp.strftime(ts_format)
+            for col, value in data.items():
+                cells[col + str(pos)] = value
+
+        cells[self.pos_cell] = pos
+        if extra_cells:
+            cells.update(extra_cells)
+
+        self.write_cells(cells)
+        self._cur_pos = pos
+
+    def column_values(self, col: str) -> List[str]:
+        """
+        Read every filled-in value in a column, top to bottom, as they're displayed on the sheet.
+        :param col: Column letter
+        """
+        self._ensure_token()
+        return self.worksheet.col_values(column_index(col))
+
+    @timed("sheet")
+    def append_block(self, rows: List[list], first_col: str = "A", update_pos: bool = True):
+        """
+        Write many rows after the last one in a single request, as one rectangular range rather than cell by cell.
+        :param rows: Lists of values, one per row, starting at first_col
+        :param first_col: Column the first value of each row goes in
+        :param update_pos: Whether to also write the new position to the position cell. Leave it off when sending
+        several blocks in a row, and set cur_pos once at the end.
+        """
+        if not rows:
+            return
 
-        pos = str(self.cur_pos)
+        start = self.cur_pos + 1
+        end = start + len(rows) - 1
+        last_col = column_letter(column_index(first_col) + max(len(row) for row in rows) - 1)
 
-        self.worksheet.update_acell(ts_col + pos, timestamp_str)
+        data = [{"range": self._sheet_range("{}{}:{}{}".format(first_col, start, last_col, end)), "values": rows}]
+        if update_pos:
+            data.append({"range": self._sheet_range(self.pos_cell), "values": [[end]]})
 
-        for col, value in data.items():
-            self.worksheet.update_acell(col + pos, value)
+        self._ensure_token()
+        self._sh.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+        self._cur_pos = end
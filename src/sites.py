@@ -0,0 +1,56 @@
+import json
+from typing import List, NamedTuple
+
+
+class Site(NamedTuple):
+    """One solar installation we poll."""
+    name: str
+    address: str
+    tag: str = "enphase"
+    static_ip: str = None
+    worksheet: str = None
+    latitude: float = None
+    longitude: float = None
+
+
+def load_sites(config_path: str = "config.json") -> List[Site]:
+    """
+    Read the list of sites from the "sites" key of the config, which looks like
+
+    "sites": [
+        {"name": "home", "address": "192.168.1", "worksheet": "Home"},
+        {"name": "shop", "address": "10.0.4", "static_ip": "10.0.4.20"}
+    ]
+
+    The tag defaults to "enphase", and the worksheet defaults to the site's name. Sites can also have their own
+    "latitude" and "longitude".
+
+    :param config_path: Path to the json config file
+    """
+    with open(config_path, "r") as raw_config_json:
+        config_json = json.load(raw_config_json)
+
+    sites = []
+    names = set()
+    for entry in config_json.get("sites", []):
+        try:
+            name = entry["name"]
+            address = entry["address"]
+        except KeyError as e:
+            raise ValueError("Site entries need a name and an address: {}".format(entry)) from e
+
+        if name in names:
+            raise ValueError("Site {} is listed more than once.".format(name))
+        names.add(name)
+
+        sites.append(Site(
+            name=name,
+            address=address,
+            tag=entry.get("tag", "enphase"),
+            static_ip=entry.get("static_ip"),
+            worksheet=entry.get("worksheet", name),
+            latitude=entry.get("latitude"),
+            longitude=entry.get("longitude")
+        ))
+
+    return sites
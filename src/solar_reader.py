@@ -1,33 +1,90 @@
-import re
+import time
+import hashlib
 import logging
+from typing import NamedTuple, Tuple
+
 import requests
-from lxml import html
+
+from src.discovery import SubnetScanner
+from src.envoy_json import EnvoyJSONParser, production_api_path, production_json_path
+from src.envoy_parser import EnvoyParser
+from src.metrics import timed
+from src.sessions import make_session
 
 log = logging.getLogger()
 
 
-number_pattern = re.compile(r"([\d.]+)")
+class SolarSample(NamedTuple):
+    """All of the values read from the solar device at one moment."""
+    timestamp: float
+    wh: int
+    mi_online: int
+    current_watts: float
+    # Whether any of the values are new since the last snapshot
+    changed: bool = True
+
+
+class _CachedPage(NamedTuple):
+    fetched: float
+    values: object
+    digest: bytes
+    etag: str
+    last_modified: str
+    changed: bool
 
 
 class SolarReader:
     """
     Handles the direct net interface with the solar panels.
+
+    Newer gateways have a JSON API, which is much cheaper to read than the html pages. With backend="auto" we check
+    for it once we've found the gateway and use it if it's there, falling back to the html pages if it isn't (or
+    stops working later on).
     """
 
-    def __init__(self, tag: str, base_ip_range: str, static_ip: str = None):
+    backends = ("auto", "json", "html")
+
+    def __init__(self, tag: str, base_ip_range: str, static_ip: str = None, snapshot_ttl: float = 30,
+                 fast_path: bool = True, timeout: Tuple[float, float] = (3.05, 10), pool_maxsize: int = 2,
+                 session: requests.Session = None, backend: str = "auto", discovery_cache: str = None):
         """
         Create the base interface.
         :param tag: Tag to use when trying to find the solar web interface.
         :param base_ip_range: IP range of the network to search. The IP
         :param static_ip: Optional static IP address. If a value is specified, then we won't attempt to search for a
         valid IP address if we can't access it.
+        :param snapshot_ttl: How long, in seconds, a fetched page may be reused before we ask the device again.
+        :param fast_path: Read values straight from the page bytes where possible, rather than building a tree.
+        :param timeout: (connect, read) timeouts for requests to the device, in seconds.
+        :param pool_maxsize: Number of keep-alive connections to hold open to the device.
+        :param session: Optional session to share with other readers. If not given, one is made for this reader.
+        :param backend: "json" to read the JSON API, "html" to read the html pages, or "auto" to use the JSON API
+        if the gateway has it.
+        :param discovery_cache: Optional file to remember the device's IP and MAC address in, so that finding it
+        again is usually instant rather than a scan of the network.
         """
+        if backend not in self.backends:
+            raise ValueError("Backend must be one of {}".format(", ".join(self.backends)))
 
         # On init, we want to verify that we can access the solar panel.
         # Might as well duck out while we still can.
 
         self._tag = tag
         self._base_ip_range = base_ip_range
+        self._scanner = SubnetScanner(tag, base_ip_range, cache_path=discovery_cache)
+
+        self._parser = EnvoyParser(fast_path)
+        self._json_parser = EnvoyJSONParser()
+        # Only the index page is read until we've found the device, so this is settled afterwards
+        self.backend = "html" if backend == "auto" else backend
+
+        self.timeout = timeout
+        self._session = session if session is not None else make_session(pool_maxsize=pool_maxsize)
+
+        self.snapshot_ttl = snapshot_ttl
+        self._page_cache = {}
+        self._snapshot = None
+        self._snapshot_time = 0
 
         self._using_static_ip = bool(static_ip)
         if self._using_static_ip:
@@ -43,32 +100,53 @@ class SolarReader:
         else:
             log.info("Found solar device at IP address {}".format(self._ip_address))
 
+        if backend == "auto":
+            self.backend = self.detect_backend()
+
+    def detect_backend(self) -> str:
+        """
+        Work out whether the gateway has the JSON API by trying to read it.
+        :return: "json" if it does, "html" otherwise
+        """
+        try:
+            self._json_parser.parse_production(self.get_response(production_api_path).content)
+            self._json_parser.parse_inverters(self.get_response(production_json_path).content)
+        except (ValueError, requests.RequestException):
+            log.info("Gateway doesn't have the JSON API, reading its html pages.")
+            return "html"
+        log.info("Gateway has the JSON API, using it.")
+        return "json"
+
+    def _fall_back_to_html(self):
+        log.warning("Couldn't read the gateway's JSON API, switching to its html pages.", exc_info=True)
+        self.backend = "html"
+
     def is_online(self) -> bool:
         """Returns whether the system should be marked as offline due to not enough microinverters being online"""
         return self.get_mi_online() > 0
 
-    def get_ip_address(self) -> str:
+    def get_ip_address(self, failed_ip: str = None) -> str:
         """
         Get the IP address of the solar panel.
 
-        Performs a quick scan through IP addresses on the network, and
+        If we have a discovery cache, first tries where it was last found and where the neighbour table says its
+        MAC address is now. Failing that, performs a concurrent scan through IP addresses on the network, and
         runs a quick regex pattern match on the HTML to see if the page
-        contains our input tag. If it does, return the IP address found.
+        contains our input tag. The first IP address found is returned.
 
+        :param failed_ip: Address that just stopped answering, not worth trying again
         :return: IP address, or None if no IP can be found.
         """
 
         if self._using_static_ip:
             return self._ip_address
 
-        for i in range(1, 256):
-            ip = "{}.{}".format(self._base_ip_range, i)
-            try:
-                response = requests.get('http://%s' % ip, timeout=2)
-                if re.search(self._tag, response.text):
-                    return ip
-            except (requests.ConnectionError, requests.Timeout):
-                continue
+        return self._scanner.locate(skip=failed_ip)
+
+    @property
+    def last_discovery_time(self) -> float:
+        """How long the last IP address search took, in seconds."""
+        return self._scanner.last_duration
 
     def solar_panels_accessible(self) -> bool:
         """
@@ -85,73 +163,190 @@ class SolarReader:
                 "Error: Can't connect to the solar array. Check the POE connection, or the status on the box.")
             raise
 
-    def get_response(self, path) -> requests.Response:
+    @timed("gateway")
+    def get_response(self, path, headers: dict = None) -> requests.Response:
         """
         Get a given HTTP response from a
         :param ip: ip address that we believe it's at
         :param path: Should be the full path including a leading slash if necessary
+        :param headers: Extra request headers
         :return:
         """
 
         try:
-            response = requests.get("http://{}{}".format(self._ip_address, path))
+            response = self._session.get("http://{}{}".format(self._ip_address, path), headers=headers,
+                                         timeout=self.timeout)
         except requests.ConnectionError as e:
             if self._using_static_ip:
                 raise e
-            new_ip = self.get_ip_address()
+            new_ip = self.get_ip_address(failed_ip=self._ip_address)
             if new_ip is not None:
                 self._ip_address = new_ip
                 log.info("IP address updated to {}.".format(new_ip))
-                response = requests.get("http://{}{}".format(new_ip, path))
+                response = self._session.get("http://{}{}".format(new_ip, path), headers=headers,
+                                             timeout=self.timeout)
             else:
                 raise RuntimeError("A seemingly valid IP address failed.")
 
         return response
 
+    def _read_page(self, path: str, parse):
+        """
+        Fetch and parse a page, reusing a recent result if it's younger than our snapshot TTL.
+
+        The gateway only refreshes its numbers every so often, so if the page comes back the same as last time
+        (by ETag/Last-Modified if the device sends them, or by a hash of the body otherwise) we skip parsing it.
+
+        :param path: Page path including the leading slash
+        :param parse: Function that turns the raw page body into values
+        """
+        now = time.monotonic()
+        cached = self._page_cache.get(path)
+        if cached is not None and now - cached.fetched < self.snapshot_ttl:
+            return cached.values
+
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        page = self.get_response(path, headers)
+        if cached is not None and page.status_code == 304:
+            self._page_cache[path] = cached._replace(fetched=now, changed=False)
+            return cached.values
+
+        digest = hashlib.sha1(page.content).digest()
+        if cached is not None and digest == cached.digest:
+            changed = False
+            values = cached.values
+        else:
+            changed = True
+            values = parse(page.content)
+
+        self._page_cache[path] = _CachedPage(now, values, digest, page.headers.get("ETag"),
+                                             page.headers.get("Last-Modified"), changed)
+        return values
+
+    def page_changed(self, path: str) -> bool:
+        """
+        Whether the last fetch of a page differed from the fetch before it.
+        :param path: Page path including the leading slash
+        """
+        cached = self._page_cache.get(path)
+        return cached is None or cached.changed
+
+    @property
+    def production_path(self) -> str:
+        """Path of the page current production is read from, for the backend in use."""
+        return production_api_path if self.backend == "json" else "/production"
+
+    @property
+    def home_path(self) -> str:
+        """Path of the page the microinverter count is read from, for the backend in use."""
+        return production_json_path if self.backend == "json" else "/home"
+
+    def _read_production(self) -> Tuple[int, float]:
+        if self.backend == "json":
+            try:
+                return self._read_page(production_api_path, self._json_parser.parse_production)[:2]
+            except ValueError:
+                self._fall_back_to_html()
+        return self._read_page("/production", self._parser.parse_production)
+
+    def _read_home(self) -> int:
+        if self.backend == "json":
+            try:
+                return self._read_page(production_json_path, self._json_parser.parse_inverters)
+            except ValueError:
+                self._fall_back_to_html()
+        return self._read_page("/home", self._parser.parse_home)
+
+    def invalidate_cache(self):
+        """Forget any cached pages, so the next read goes to the device."""
+        self._page_cache.clear()
+
+    def get_snapshot(self) -> SolarSample:
+        """
+        Read every value we track from a single fetch of each page.
+
+        Repeated calls within snapshot_ttl seconds are served from the cache, so all values in a
+        row describe the same moment.
+        """
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._snapshot_time < self.snapshot_ttl:
+            return self._snapshot
+
+        wh, current_watts = self._read_production()
+        mi_online = self._read_home()
+
+        self.record_reading(wh, mi_online, current_watts)
+        self._snapshot_time = now
+        return self._snapshot
+
+    def record_reading(self, wh: int, mi_online: int, current_watts: float) -> SolarSample:
+        """
+        Turn values just read from the gateway into a sample, deciding whether they're new by comparing them with
+        the last sample. Any path that reads the pages itself should pass what it read through here.
+
+        :param wh: Energy generated today in watt-hours, or None if it couldn't be read
+        :param mi_online: Number of microinverters online, or None if it couldn't be read
+        :param current_watts: Current production in watts, or None if it couldn't be read
+        :return: The new sample. If the reading is an old or partial page, the last sample, marked unchanged.
+        """
+        changed = self.page_changed(self.production_path) or self.page_changed(self.home_path)
+        previous = self._snapshot
+        if changed and previous is not None:
+            if (wh, mi_online, current_watts) == (previous.wh, previous.mi_online, previous.current_watts):
+                # The page moved but none of the numbers we care about did
+                changed = False
+            elif (wh is not None and previous.wh is not None and wh < previous.wh and
+                  time.localtime(previous.timestamp).tm_yday == time.localtime().tm_yday):
+                # Today's total only ever goes up until midnight, so this is an old or partial page.
+                log.warning("Today's production went backwards from {} to {} Wh, ignoring this reading."
+                            .format(previous.wh, wh))
+                self._snapshot = previous._replace(changed=False)
+                return self._snapshot
+
+        self._snapshot = SolarSample(
+            timestamp=time.time() if changed or previous is None else previous.timestamp,
+            wh=wh,
+            mi_online=mi_online,
+            current_watts=current_watts,
+            changed=changed
+        )
+        return self._snapshot
+
     def get_wh_production(self) -> int:
         """
         Get the total energy generated today in watt-hours.
         """
-        page = self.get_response("/production")  # Pull the webpage
-        tree = html.fromstring(page.text)
-        data = tree.xpath("/html/body/div[1]/table/tr[3]/td[2]/text()")  # Grab the value
+        return self._read_production()[0]
 
-        match = number_pattern.findall(data[0])
-        try:
-            data_float = float(match[0])
-        except ValueError:
-            log.exception("Couldn't convert to float")
-            return 0
-
-        if "kW" in data[0]:
-            data_float *= 1000
+    def read_current_watts(self) -> float:
+        """
+        Fetch the current production straight from the gateway, bypassing the page cache. This is for sampling
+        more often than full readings are taken, and doesn't affect what get_snapshot() sees as changed.
+        """
+        if self.backend == "json":
+            return self._json_parser.parse_production(self.get_response(production_api_path).content)[1]
+        return self._parser.parse_production(self.get_response("/production").content)[1]
 
-        energy_wh = int(data_float)  # Convert it to the base unit, watt hours, to make math easier
-        return energy_wh
+    def get_lifetime_wh(self) -> int:
+        """
+        Get the total energy generated since installation in watt-hours. Only the JSON API gives this exactly, so
+        it's None when reading the html pages.
+        """
+        if self.backend != "json":
+            return None
+        return self._read_page(production_api_path, self._json_parser.parse_production)[2]
 
     def get_current_watt_production(self) -> float:
         """
         Get the current amount of watts being generated by the solar panels.
         """
-        page = self.get_response("/production")
-        # page = requests.get("http://%s/production" % ip_address)
-        tree = html.fromstring(page.text)
-        data = tree.xpath("/html/body/div[1]/table/tr[2]/td[2]/text()")
-        match = number_pattern.findall(data[0])
-        try:
-            data_float = float(match[0])
-        except ValueError:
-            log.exception("Couldn't convert to float")
-            return 0
-        except IndexError:
-            # It seems like wattage is sometimes unavailable and it isn't really clear why
-            log.info("Couldn't find a numerical value in the field. Instead, had value of {}".format(data))
-            return 0
-        # cur_kw = float(data[0].strip().rstrip(" kW"))
-
-        if "kW" in data[0]:
-            data_float *= 1000  # Convert it to watts
-        return data_float
+        return self._read_production()[1]
 
     def get_mi_online(self):
         """
@@ -163,10 +358,4 @@ class SolarReader:
         panels, and therefore make for a good measure of the health of the system.
         """
         log.info("Determining current solar cell status...")
-        page = self.get_response("/home")
-        tree = html.fromstring(page.text)
-        data = tree.xpath("/html/body/table/tr/td[2]/table/tr[5]/td[2]/text()")
-        mi_online = int(data[0])
-        # Note: I had to remove tbody from xpath Chrome gave me, and add '/text()' after it.
-        log.debug("%s out of 24 microinverters online" % mi_online)
-        return mi_online
+        return self._read_home()
@@ -0,0 +1,103 @@
+import sqlite3
+import threading
+from typing import List
+
+
+class SQLiteWriter:
+    """
+    Stores rows in a SQLite database, as a queryable alternative to the csv file.
+
+    Rows are inserted in batches of batch_size, and the table is indexed on timestamp so that time range and latest
+    value lookups don't need to scan the whole history. The database uses write-ahead logging, so readers don't
+    block the writer.
+    """
+
+    def __init__(self, db_path: str, fields: List[str], batch_size: int = 1, table: str = "samples"):
+        """
+        :param db_path: Path to the database file
+        :param fields: Column names, in order. Must include "timestamp", stored as epoch seconds.
+        :param batch_size: Number of rows to buffer before inserting them
+        :param table: Name of the table to write to
+        """
+        if "timestamp" not in fields:
+            raise ValueError("Fields must include a timestamp.")
+        for name in [table] + fields:
+            if not name.isidentifier():
+                raise ValueError("{} can't be used as a table or column name.".format(name))
+
+        self.db_path = db_path
+        self.fields = fields
+        self.batch_size = batch_size
+        self.table = table
+
+        self._pending = []
+        self._lock = threading.Lock()
+
+        # Readers (like the live API) may be on other threads, so access goes through our lock instead.
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        columns = ", ".join("timestamp REAL NOT NULL" if name == "timestamp" else name for name in fields)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(table, columns))
+            self._conn.execute("CREATE INDEX IF NOT EXISTS {0}_timestamp ON {0} (timestamp)".format(table))
+            # Databases made before a column was added get it now
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info({})".format(table))}
+            for name in fields:
+                if name not in existing:
+                    self._conn.execute("ALTER TABLE {} ADD COLUMN {}".format(table, name))
+
+        self._insert_sql = "INSERT INTO {} ({}) VALUES ({})".format(table, ", ".join(fields),
+                                                                   ", ".join("?" for _ in fields))
+
+    def write_row(self, row_data: dict):
+        with self._lock:
+            self._pending.append(tuple(row_data.get(name) for name in self.fields))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        with self._conn:
+            self._conn.executemany(self._insert_sql, self._pending)
+        self._pending = []
+
+    def flush(self):
+        """Insert any buffered rows."""
+        with self._lock:
+            self._flush()
+
+    def _query(self, sql: str, params: tuple = ()) -> List[dict]:
+        with self._lock:
+            self._flush()
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(zip(self.fields, row)) for row in rows]
+
+    def query_range(self, start: float = None, end: float = None) -> List[dict]:
+        """
+        Get the rows in a time range, oldest first.
+        :param start: Earliest timestamp to include, or None for no lower bound
+        :param end: Timestamp to stop before, or None for no upper bound
+        """
+        sql = "SELECT {} FROM {} WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp".format(
+            ", ".join(self.fields), self.table)
+        return self._query(sql, (float("-inf") if start is None else start, float("inf") if end is None else end))
+
+    def latest(self, count: int = 1) -> List[dict]:
+        """
+        Get the most recent rows, newest first.
+        :param count: Number of rows to return
+        """
+        sql = "SELECT {} FROM {} ORDER BY timestamp DESC LIMIT ?".format(", ".join(self.fields), self.table)
+        return self._query(sql, (count,))
+
+    def close(self):
+        """Insert any buffered rows and close the database."""
+        with self._lock:
+            if self._conn is None:
+                return
+            self._flush()
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,82 @@
+import datetime
+import json
+import math
+from typing import NamedTuple, Optional, Tuple
+
+# Days between the julian day epoch and the unix epoch
+_unix_epoch_jd = 2440587.5
+_j2000 = 2451545.0
+
+# Sun's apparent radius plus refraction at the horizon, in degrees
+_horizon_angle = -0.833
+_obliquity = 23.4397
+
+
+class SunTimes(NamedTuple):
+    """
+    Sun events for one day, as timezone-aware datetimes.
+    Sunrise and sunset are None if the sun doesn't rise or set that day (near the poles).
+    """
+    sunrise: Optional[datetime.datetime]
+    noon: datetime.datetime
+    sunset: Optional[datetime.datetime]
+
+
+def _to_datetime(julian_day: float, tz: datetime.tzinfo = None) -> datetime.datetime:
+    timestamp = (julian_day - _unix_epoch_jd) * 86400
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).astimezone(tz)
+
+
+def sun_times(latitude: float, longitude: float, date: datetime.date = None,
+              tz: datetime.tzinfo = None) -> SunTimes:
+    """
+    Work out sunrise, solar noon and sunset with the sunrise equation. Good to within a minute or two, which is
+    plenty for deciding when to start and stop polling, and needs no network or extra packages.
+
+    :param latitude: Latitude in degrees, north positive
+    :param longitude: Longitude in degrees, east positive
+    :param date: Day to calculate for. Defaults to today.
+    :param tz: Timezone for the results. Defaults to the local timezone.
+    """
+    if date is None:
+        date = datetime.date.today()
+
+    # Whole days from J2000 to the given day
+    midnight_utc = datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc)
+    n = math.ceil(midnight_utc.timestamp() / 86400 + _unix_epoch_jd - _j2000 + 0.0008)
+
+    mean_solar_time = n - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_time) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.0200 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic_longitude = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = _j2000 + mean_solar_time + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(math.radians(_obliquity)))
+    lat = math.radians(latitude)
+    cos_hour_angle = ((math.sin(math.radians(_horizon_angle)) - math.sin(lat) * math.sin(declination))
+                      / (math.cos(lat) * math.cos(declination)))
+
+    noon = _to_datetime(transit, tz)
+    if not -1 <= cos_hour_angle <= 1:
+        # Polar night or midnight sun
+        return SunTimes(None, noon, None)
+
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    return SunTimes(_to_datetime(transit - hour_angle / 360, tz), noon, _to_datetime(transit + hour_angle / 360, tz))
+
+
+def load_location(config_path: str = "config.json") -> Optional[Tuple[float, float]]:
+    """
+    Read the "latitude" and "longitude" keys from the config.
+    :return: (latitude, longitude), or None if they aren't set
+    """
+    try:
+        with open(config_path, "r") as raw_config_json:
+            config_json = json.load(raw_config_json)
+    except FileNotFoundError:
+        return None
+
+    try:
+        return float(config_json["latitude"]), float(config_json["longitude"])
+    except KeyError:
+        return None
@@ -0,0 +1,110 @@
+import datetime
+import logging
+import threading
+
+log = logging.getLogger()
+
+
+class TokenManager:
+    """
+    Keeps the sheet client's access token fresh.
+
+    A background thread refreshes the credentials a little before they expire, so writes never stop to do it
+    themselves. If a write does find the token expired (say the background refresh failed), it refreshes inline;
+    several threads finding it expired at once share a single refresh.
+    """
+
+    def __init__(self, credentials, client, margin: float = 300, retry_interval: float = 30):
+        """
+        :param credentials: oauth2client credentials
+        :param client: gspread client authorized with the credentials
+        :param margin: How long before expiry to refresh, in seconds
+        :param retry_interval: How long to wait before trying again after a failed refresh, in seconds
+        """
+        self.credentials = credentials
+        self.client = client
+        self.margin = margin
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._refreshing = False
+        self._error = None
+
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def seconds_left(self) -> float:
+        """Time until the access token expires, in seconds. 0 if we don't have one."""
+        expiry = getattr(self.credentials, "token_expiry", None)
+        if self.credentials.access_token is None or expiry is None:
+            return 0
+        return (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def _refresh(self):
+        import httplib2
+
+        self.credentials.refresh(httplib2.Http())
+        # With a valid token in hand, this just puts it on the client's requests
+        self.client.login()
+
+    def refresh(self):
+        """
+        Get a new access token. If a refresh is already under way, wait for that one instead of starting another.
+        Raises if the refresh fails.
+        """
+        with self._lock:
+            if self._refreshing:
+                while self._refreshing:
+                    self._done.wait()
+                if self._error is not None:
+                    raise self._error
+                return
+            self._refreshing = True
+            self._error = None
+
+        error = None
+        try:
+            self._refresh()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._error = error
+                self._done.notify_all()
+
+    def ensure_fresh(self):
+        """Make sure the token is valid. Only goes to the network if it has actually expired."""
+        if self.credentials.access_token_expired:
+            log.info("Access token expired before it was refreshed, refreshing it now.")
+            self.refresh()
+
+    def _run(self):
+        delay = max(0, self.seconds_left() - self.margin)
+        while not self._stopping.wait(delay):
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("Failed to refresh the sheet's access token, trying again in {}s."
+                              .format(self.retry_interval))
+                delay = self.retry_interval
+                continue
+            delay = max(self.retry_interval, self.seconds_left() - self.margin)
+            log.debug("Refreshed the sheet's access token, next refresh in {:.0f}s.".format(delay))
+
+    def start(self):
+        """Start refreshing in the background."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="token-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        """Stop refreshing in the background."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
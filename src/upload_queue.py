@@ -0,0 +1,211 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Tuple
+
+from src.sheet_manager import SheetReader
+
+log = logging.getLogger()
+
+
+class UploadQueue:
+    """
+    Write-behind queue that sits between the sampler and the google sheet.
+
+    Rows are appended to a spool file on disk first, and a background thread uploads them to the sheet in
+    batches. The number of bytes of the spool that have made it to the sheet is kept in a separate offset file,
+    so pending rows survive a restart and are uploaded in the order they were taken.
+
+    Delivery is at-least-once: if we die between an upload and writing the offset, that batch is sent again.
+    A line that can't be read (torn by a crash while it was written) is moved to a .rejected file and skipped.
+    """
+
+    def __init__(self, sheet_reader: SheetReader, spool_path: str, batch_size: int = 50, interval: float = 5,
+                 max_backoff: float = 600):
+        """
+        :param sheet_reader: Sheet that rows are uploaded to
+        :param spool_path: Path to the on-disk spool file
+        :param batch_size: Maximum number of rows sent in one request
+        :param interval: How often, in seconds, the uploader checks for new rows
+        :param max_backoff: Longest we'll wait between attempts while the sheet is failing
+        """
+        self.sheet_reader = sheet_reader
+        self.spool_path = spool_path
+        self.offset_path = spool_path + ".offset"
+        self.rejected_path = spool_path + ".rejected"
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _read_offset(self) -> int:
+        try:
+            with open(self.offset_path, "r") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset: int):
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    def put(self, data: dict, extra_cells: dict = None, timestamp: float = None):
+        """
+        Queue a row for upload. Returns once the row is safely on disk.
+        :param data: Dict of column to value, as passed to SheetReader.update_row
+        :param extra_cells: Other cells to write alongside the row
+        :param timestamp: Epoch time the row was sampled at. Defaults to now.
+        """
+        record = {
+            "timestamp": time.time() if timestamp is None else timestamp,
+            "data": data,
+            "extra_cells": extra_cells or {}
+        }
+        line = json.dumps(record) + "\n"
+
+        with self._lock:
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._wake.set()
+
+    def _reject(self, line: bytes, offset: int):
+        """Set aside a line we can't read, and step the offset past it so it doesn't hold up the rows after it."""
+        log.error("Couldn't read a queued row at byte {} of {}, moving it to {}."
+                  .format(offset, self.spool_path, self.rejected_path))
+        with open(self.rejected_path, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._write_offset(offset + len(line))
+
+    def pending(self) -> Tuple[List[dict], int]:
+        """Get up to batch_size of the oldest rows that haven't been uploaded yet, and the offset after them."""
+        offset = self._read_offset()
+        records = []
+        try:
+            if offset > os.path.getsize(self.spool_path):
+                # The spool was emptied after the offset was written, and we stopped before resetting it
+                offset = 0
+            with open(self.spool_path, "rb") as f:
+                f.seek(offset)
+                while len(records) < self.batch_size:
+                    line = f.readline()
+                    # A line without a newline is still being written (or was cut off by a crash).
+                    if not line.endswith(b"\n"):
+                        break
+                    if line.strip():
+                        try:
+                            record = json.loads(line.decode("utf-8"))
+                        except ValueError:
+                            if records:
+                                # Send what we have first, the bad line will lead the next batch
+                                break
+                            self._reject(line, offset)
+                            offset += len(line)
+                            continue
+                        records.append(record)
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+
+        return records, offset
+
+    def drain_once(self) -> int:
+        """
+        Upload one batch of pending rows.
+        :return: Number of rows uploaded
+        """
+        records, new_offset = self.pending()
+        if not records:
+            return 0
+
+        rows = []
+        extra_cells = {}
+        for record in records:
+            rows.append((datetime.datetime.fromtimestamp(record["timestamp"]), record["data"]))
+            # Later rows win, so the extra cells end up holding the newest values.
+            extra_cells.update(record["extra_cells"])
+
+        self.sheet_reader.update_rows(rows, extra_cells=extra_cells)
+
+        with self._lock:
+            if new_offset >= os.path.getsize(self.spool_path):
+                # Everything has been uploaded, so start the spool over rather than letting it grow forever. The
+                # offset goes first: if we die in between, we resend the spool rather than skip into the next one.
+                self._write_offset(0)
+                open(self.spool_path, "w").close()
+            else:
+                self._write_offset(new_offset)
+
+        log.info("Uploaded {} queued row(s) to the sheet.".format(len(records)))
+        return len(records)
+
+    def drain(self) -> int:
+        """
+        Upload everything pending.
+        :return: Number of rows uploaded
+        """
+        total = 0
+        while True:
+            uploaded = self.drain_once()
+            if not uploaded:
+                return total
+            total += uploaded
+
+    def _run(self):
+        delay = self.interval
+        while not self._stopping.is_set():
+            if delay > self.interval:
+                # Backing off: new rows shouldn't cut the wait short, only a stop request should.
+                self._stopping.wait(delay)
+            else:
+                self._wake.wait(delay)
+            self._wake.clear()
+            try:
+                self.drain()
+                delay = self.interval
+            except Exception:
+                delay = min(self.max_backoff, delay * 2)
+                log.exception("Failed to upload queued rows, retrying in {}s.".format(delay))
+
+    def start(self):
+        """Start the background uploader."""
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="sheet-uploader", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 60):
+        """
+        Stop the background uploader, making one last attempt to upload anything still pending.
+        :param timeout: How long to wait for the uploader to finish
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log.warning("Uploader is still busy, queued rows will be sent on the next run.")
+            return
+        self._thread = None
+
+        try:
+            self.drain()
+        except Exception:
+            log.exception("Rows are still queued for upload and will be sent on the next run.")
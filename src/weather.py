@@ -1,6 +1,12 @@
 import json
 import logging
-import requests
+import os
+import threading
+import time
+from typing import Tuple
+
+from src.metrics import timed, weather_age
+from src.sessions import make_session
 
 log = logging.getLogger()
 
@@ -20,28 +26,72 @@ class WeatherData:
     pair up against our solar data (as a curiosity).
 
     All we really care about is how cloudy the area is.
+
+    Cloud cover changes slowly, so readings are cached for weather_cache_ttl seconds (from the config).
+    Once a reading goes stale we keep serving it while a background thread fetches a new one, and the
+    last good reading is saved to weather_cache_path so a restart doesn't need to wait on the API.
     """
 
-    def __init__(self, config_fp: str = "config.json"):
+    api_url = "http://api.openweathermap.org/data/2.5/weather?id={}&APPID={}"
+
+    def __init__(self, config_fp: str = "config.json", timeout: Tuple[float, float] = (3.05, 10)):
+        """
+        :param config_fp: Path to the json config file
+        :param timeout: (connect, read) timeouts for requests to the weather API, in seconds
+        """
 
         with open(config_fp, "r") as raw_config_json:
             config_json = json.load(raw_config_json)
 
         self._functional = True
 
+        self.timeout = timeout
+        self._session = make_session()
+
         try:
             self._api_key = config_json["weather_api_key"]
             self._city_id = config_json["weather_city_id"]
         except KeyError:
             log.exception("Failed to find API keys, weather data will be dummied out.")
+            self._functional = False
+
+        self.cache_ttl = config_json.get("weather_cache_ttl", 1800)
+        self.cache_path = config_json.get("weather_cache_path",
+                                          os.path.join(os.path.dirname(os.path.abspath(config_fp)),
+                                                       "weather_cache.json"))
+
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._cloud_levels = None
+        self._fetched_at = None
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                cached = json.load(f)
+            self._cloud_levels = cached["cloud_levels"]
+            self._fetched_at = cached["fetched_at"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            log.warning("Ignoring unreadable weather cache at {}".format(self.cache_path))
+
+    def _save_cache(self):
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"cloud_levels": self._cloud_levels, "fetched_at": self._fetched_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            log.exception("Couldn't save the weather cache.")
 
     def _get_current_weather_data(self) -> dict:
         """
         Get weather data from our API at city_id.
         :return: Weather data json response
         """
-        url_base = "http://api.openweathermap.org/data/2.5/weather?id={}&APPID={}"
-        resp = requests.get(url_base.format(self._city_id, self._api_key))
+        resp = self._session.get(self.api_url.format(self._city_id, self._api_key), timeout=self.timeout)
 
         json_resp = json.loads(resp.text)
 
@@ -51,16 +101,11 @@ class WeatherData:
         else:
             return json_resp
 
-    def get_cloud_levels(self) -> float:
+    @timed("weather")
+    def _fetch_cloud_levels(self) -> float:
         """
-        Get the cloud levels (float percentage out of 1) at the location specified in the class.
-
-        :return: Cloud levels out of 1, or -1 if an error occurred.
+        Ask the API for the current cloud levels (float percentage out of 1).
         """
-
-        if not self._functional:
-            return -1
-
         weather = self._get_current_weather_data()
 
         try:
@@ -71,3 +116,66 @@ class WeatherData:
         cloud_data = int(cloud_data) / 100
 
         return cloud_data
+
+    def refresh(self):
+        """
+        Fetch new cloud levels and update the cache. Errors are logged, and leave the last good value in place.
+        """
+        try:
+            cloud_levels = self._fetch_cloud_levels()
+        except (Exception, WeatherAPIError):
+            log.exception("Failed to refresh weather data, keeping the last reading.")
+            with self._lock:
+                self._refreshing = False
+            return
+
+        with self._lock:
+            self._cloud_levels = cloud_levels
+            self._fetched_at = time.time()
+            # Only once the new reading is in place, or a caller could see the old age and start another refresh
+            self._refreshing = False
+            self._save_cache()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="weather-refresh", daemon=True).start()
+
+    def get_cloud_levels_with_age(self) -> Tuple[float, float]:
+        """
+        Get the cloud levels along with how old the reading is.
+
+        Only the very first reading (with nothing cached on disk) waits on the API.
+        After that, stale readings are returned straight away and refreshed in the background.
+
+        :return: Cloud levels out of 1 (or -1 if we have no reading), and the reading's age in seconds.
+        """
+
+        if not self._functional:
+            return -1, 0
+
+        if self._cloud_levels is None:
+            self.refresh()
+
+        with self._lock:
+            cloud_levels, fetched_at = self._cloud_levels, self._fetched_at
+
+        if cloud_levels is None:
+            return -1, 0
+
+        age = time.time() - fetched_at
+        if age >= self.cache_ttl:
+            self._refresh_in_background()
+
+        weather_age.set(age)
+        return cloud_levels, age
+
+    def get_cloud_levels(self) -> float:
+        """
+        Get the cloud levels (float percentage out of 1) at the location specified in the class.
+
+        :return: Cloud levels out of 1, or -1 if an error occurred.
+        """
+        return self.get_cloud_levels_with_age()[0]